@@ -0,0 +1,275 @@
+"""Run the offline benchmark suite.
+
+Every stage runs in a fresh process, so the peak RSS reported for it is that of
+the stage alone. The synthetic inputs are prepared by the parent process, which
+also hosts the Ceneton stand-in server for the download stages.
+
+    python -m benchmarks.run --save-baseline baseline.json
+    python -m benchmarks.run --baseline baseline.json --threshold 0.2
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import click
+
+from benchmarks.server import CenetonStandIn
+from benchmarks.synthetic import (
+    CENETON_TABLE,
+    create_archive,
+    create_ceneton_sqlite,
+    create_mappings_csv,
+)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _measure(function, *args) -> dict:
+    """Run a stage function in this process and report its cost."""
+    os.environ["TQDM_DISABLE"] = "1"
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        items = function(*args)
+        seconds = time.perf_counter() - start
+
+    return {
+        "seconds": round(seconds, 4),
+        "items": items,
+        "items_per_second": round(items / seconds, 1) if seconds else 0,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+# Stages. Each runs in a child process and returns the number of items processed.
+
+
+def populate_from_sqlite_stage(folder: Path, census_path: Path) -> int:
+    from ceneton_texts_utils.url_database import URLDatabase, populate_from_sqlite
+
+    folder.mkdir(parents=True, exist_ok=True)
+    database = URLDatabase(folder / "index.csv", create_if_missing=True)
+    populate_from_sqlite(database, census_path, CENETON_TABLE)
+    return len(database.database_entries)
+
+
+def populate_from_mappings_stage(database_path: Path, mappings_path: Path) -> int:
+    from ceneton_texts_utils.url_database import URLDatabase, populate_from_mappings
+
+    database = URLDatabase(database_path)
+    populate_from_mappings(database, mappings_path)
+    with open(mappings_path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def index_ceneton_stage(
+    census_path: Path, database_path: Path, output_path: Path
+) -> int:
+    from ceneton_texts_utils.indexer import index_ceneton
+
+    index_ceneton(census_path, database_path, output_path, CENETON_TABLE)
+    with open(output_path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def convert_entry_stage(database_path: Path) -> int:
+    from ceneton_texts_utils.url_database import URLDatabase
+    from ceneton_texts_utils.w3m import BuiltinConverter
+
+    converter = BuiltinConverter()
+    converted = 0
+    for entry in URLDatabase(database_path):
+        if entry.content_path.exists():
+            converter.convert_entry(entry, force=True)
+            converted += 1
+    return converted
+
+
+def download_stage(database_path: Path, workers: int) -> int:
+    from ceneton_texts_utils.download import HostRateLimiter, download_all_urls
+    from ceneton_texts_utils.url_database import URLDatabase
+
+    database = URLDatabase(database_path)
+    limiter = HostRateLimiter(max_in_flight=workers, requests_per_second=None)
+    download_all_urls(database, workers=workers, limiter=limiter)
+    return len(database.database_entries)
+
+
+def _run_stage(function, *args) -> dict:
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(_measure, function, *args).result()
+
+
+def run_benchmarks(
+    folder: Path,
+    entries: int,
+    content_entries: int,
+    crawl_entries: int,
+    workers: int,
+    latency: float,
+    change_rate: float,
+):
+    """Prepare the synthetic inputs in folder and yield (stage, result) pairs."""
+    census_path = folder / "ceneton.sqlite"
+    create_ceneton_sqlite(census_path, entries)
+
+    yield (
+        "populate_from_sqlite",
+        _run_stage(populate_from_sqlite_stage, folder / "populate", census_path),
+    )
+
+    mappings_path = folder / "mappings.csv"
+    create_mappings_csv(mappings_path, max(1, entries // 10), entries)
+    database_path = create_archive(folder / "mappings", entries)
+    yield (
+        "populate_from_mappings",
+        _run_stage(populate_from_mappings_stage, database_path, mappings_path),
+    )
+
+    database_path = create_archive(folder / "archive", entries, content_entries)
+    yield (
+        "index_ceneton",
+        _run_stage(
+            index_ceneton_stage, census_path, database_path, folder / "index.csv"
+        ),
+    )
+    yield "convert_entry", _run_stage(convert_entry_stage, database_path)
+
+    stand_in = CenetonStandIn(crawl_entries, latency=latency, change_rate=change_rate)
+    base_url = stand_in.start()
+    try:
+        database_path = create_archive(
+            folder / "crawl", crawl_entries, base_url=base_url, last_status=None
+        )
+        yield "download_initial", _run_stage(download_stage, database_path, workers)
+
+        stand_in.advance()
+        stand_in.status_counts.clear()
+        result = _run_stage(download_stage, database_path, workers)
+        result["status_counts"] = dict(stand_in.status_counts)
+        yield "download_recrawl", result
+    finally:
+        stand_in.stop()
+
+
+def _compare(result: dict, baseline: dict | None) -> str:
+    if not baseline or not baseline.get("seconds"):
+        return ""
+    change = result["seconds"] / baseline["seconds"] - 1
+    return f"{change:+.1%}"
+
+
+@click.command()
+@click.option("--entries", type=int, default=12500, help="Size of the archive")
+@click.option(
+    "--content-entries",
+    type=int,
+    default=500,
+    help="Number of entries with archived content to convert",
+)
+@click.option(
+    "--crawl-entries", type=int, default=2000, help="Number of pages to crawl"
+)
+@click.option("-w", "--workers", type=int, default=8, help="Download workers")
+@click.option("--latency", type=float, default=0.0, help="Server seconds per page")
+@click.option(
+    "--change-rate",
+    type=float,
+    default=0.01,
+    help="Fraction of pages that change before the recrawl",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Results of an earlier run to compare with",
+)
+@click.option(
+    "--save-baseline",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Save the results to this file",
+)
+@click.option(
+    "--threshold",
+    type=float,
+    default=None,
+    help="Exit with an error if a stage is slower than the baseline by more than "
+    "this fraction",
+)
+@click.option(
+    "--keep",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Prepare the inputs in this folder and keep them",
+)
+def main(
+    entries: int,
+    content_entries: int,
+    crawl_entries: int,
+    workers: int,
+    latency: float,
+    change_rate: float,
+    baseline: Path | None,
+    save_baseline: Path | None,
+    threshold: float | None,
+    keep: Path | None,
+):
+    """Benchmark the main pipeline stages against synthetic data."""
+    baseline_results = json.loads(baseline.read_text()) if baseline else {}
+
+    with contextlib.ExitStack() as stack:
+        if keep:
+            keep.mkdir(parents=True, exist_ok=True)
+            folder = keep
+        else:
+            folder = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+
+        print(
+            f"{'stage':<24} {'seconds':>9} {'items':>7} {'items/s':>10} "
+            f"{'peak MB':>8} {'vs base':>8}"
+        )
+        results = {}
+        for name, result in run_benchmarks(
+            folder,
+            entries,
+            content_entries,
+            crawl_entries,
+            workers,
+            latency,
+            change_rate,
+        ):
+            results[name] = result
+            print(
+                f"{name:<24} {result['seconds']:>9.3f} {result['items']:>7} "
+                f"{result['items_per_second']:>10.1f} {result['peak_rss_mb']:>8.1f} "
+                f"{_compare(result, baseline_results.get(name)):>8}"
+            )
+
+    if save_baseline:
+        save_baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Saved results to {save_baseline}")
+
+    if threshold is not None and baseline_results:
+        regressions = [
+            name
+            for name, result in results.items()
+            if name in baseline_results
+            and result["seconds"] > baseline_results[name]["seconds"] * (1 + threshold)
+        ]
+        if regressions:
+            raise click.ClickException(
+                f"Slower than baseline: {', '.join(regressions)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
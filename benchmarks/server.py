@@ -0,0 +1,145 @@
+"""A local stand-in for the Ceneton web server."""
+
+import random
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+from benchmarks.synthetic import play_html
+
+# Pages are last modified one day after this for every version
+BASE_TIMESTAMP = 1_600_000_000
+
+
+class CenetonStandIn:
+    """Serves synthetic pages with ETag and Last-Modified validators.
+
+    Every page starts at version 0. `advance` bumps the version of a random
+    `change_rate` fraction of the pages, so a recrawl sees that many changes.
+    Each response is delayed by `latency` seconds.
+    """
+
+    def __init__(
+        self, pages: int, latency: float = 0.0, change_rate: float = 0.01, seed=0
+    ):
+        self.pages = pages
+        self.latency = latency
+        self.change_rate = change_rate
+        self.versions = [0] * (pages + 1)
+        self.status_counts: dict[int, int] = {}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: ThreadingHTTPServer | None = None
+
+    def advance(self) -> int:
+        changed = self._random.sample(
+            range(1, self.pages + 1), int(self.pages * self.change_rate)
+        )
+        for number in changed:
+            self.versions[number] += 1
+        return len(changed)
+
+    def _count(self, status: int):
+        with self._lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, status: int, headers: dict[str, str], body=b""):
+                stand_in._count(status)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if body and self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+
+                name = self.path.rsplit("/", 1)[-1]
+                try:
+                    number = int(name.removeprefix("synthetic").removesuffix(".html"))
+                    assert 1 <= number <= stand_in.pages
+                except (ValueError, AssertionError):
+                    self._respond(404, {})
+                    return
+
+                version = stand_in.versions[number]
+                timestamp = BASE_TIMESTAMP + version * 86400
+                headers = {
+                    "ETag": f'"{number}-{version}"',
+                    "Last-Modified": formatdate(timestamp, usegmt=True),
+                }
+
+                if self.headers.get("If-None-Match") == headers["ETag"]:
+                    self._respond(304, headers)
+                    return
+                since = self.headers.get("If-Modified-Since")
+                if since and parsedate_to_datetime(since).timestamp() >= timestamp:
+                    self._respond(304, headers)
+                    return
+
+                headers["Content-Type"] = "text/html; charset=windows-1252"
+                self._respond(200, headers, play_html(number, version))
+
+            do_HEAD = do_GET
+
+        return Handler
+
+    def start(self, port: int = 0) -> str:
+        """Start serving in a background thread and return the base URL."""
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/Dutch/Ceneton"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+@click.command()
+@click.option("--pages", type=int, default=12500)
+@click.option("--port", type=int, default=8000)
+@click.option("--latency", type=float, default=0.0, help="Seconds per response")
+@click.option("--change-rate", type=float, default=0.01)
+@click.option(
+    "--advance-every",
+    type=float,
+    default=0,
+    help="Change pages every this many seconds (0 to never change them)",
+)
+def main(pages: int, port: int, latency: float, change_rate: float, advance_every):
+    """Run the stand-in server until interrupted."""
+    stand_in = CenetonStandIn(pages, latency=latency, change_rate=change_rate)
+    print(f"Serving {pages} pages at {stand_in.start(port)}")
+    try:
+        while True:
+            if advance_every:
+                time.sleep(advance_every)
+                print(f"Changed {stand_in.advance()} pages")
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        stand_in.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Measure the cold start of the ct-utils CLI.
+
+Every cron job and per-entry script pays for the imports of `ct-utils` before
+any work starts. This reports the import time of the CLI module with
+`python -X importtime`, the modules that take the longest, and the wall time of
+`ct-utils --help` over a bare interpreter start:
+
+    python -m benchmarks.startup --budget-ms 80
+
+The run fails if the CLI module takes longer than the budget to import, or if it
+imports any of the modules that only the commands themselves should need.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+CLI_MODULE = "ceneton_texts_utils.__main__"
+
+# Dependencies that must only be imported when a command runs
+DEFERRED_MODULES = ("requests", "yaml", "tqdm", "sqlite3")
+
+
+def _environment() -> dict[str, str]:
+    src = str(Path(__file__).parent.parent / "src")
+    python_path = os.environ.get("PYTHONPATH")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = f"{src}{os.pathsep}{python_path}" if python_path else src
+    return env
+
+
+def import_times() -> dict[str, tuple[int, int]]:
+    """Import the CLI in a fresh interpreter and return the self and cumulative
+    import time in microseconds of every module it imported."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {CLI_MODULE}"],
+        env=_environment(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like "import time:       580 |      18788 |   click". Modules
+    # imported by site before our code runs are included, but are not counted
+    # against the CLI, as they are not nested in its import.
+    times = {}
+    collecting = False
+    lines = result.stderr.splitlines()
+    for line in reversed(lines):
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        depth = len(name) - len(name.lstrip())
+        name = name.strip()
+        if name == CLI_MODULE:
+            collecting = True
+        elif collecting and depth <= 1:
+            break
+        if collecting:
+            times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def wall_time(args: list[str], runs: int) -> float:
+    """Median seconds to run the interpreter with args."""
+    env = _environment()
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args], env=env, stdout=subprocess.DEVNULL, check=True
+        )
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+@click.command()
+@click.option(
+    "--budget-ms",
+    type=float,
+    default=80.0,
+    help="Fail if importing the CLI takes longer than this",
+)
+@click.option("--runs", type=click.IntRange(min=1), default=10)
+@click.option("--top", type=int, default=10, help="Number of slowest modules to list")
+def main(budget_ms: float, runs: int, top: int):
+    """Benchmark how long the CLI takes to start."""
+    samples = [import_times() for _ in range(runs)]
+    import_ms = statistics.median(s[CLI_MODULE][1] for s in samples) / 1000
+
+    print(f"{'module':<40} {'self ms':>8} {'total ms':>9}")
+    slowest = sorted(samples[-1].items(), key=lambda item: -item[1][0])[:top]
+    for name, (self_us, cumulative_us) in slowest:
+        print(f"{name:<40} {self_us / 1000:>8.1f} {cumulative_us / 1000:>9.1f}")
+
+    interpreter = wall_time(["-c", "pass"], runs)
+    cli = wall_time(["-m", "ceneton_texts_utils", "--help"], runs)
+    print(f"\nImport of {CLI_MODULE}: {import_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+    print(
+        f"ct-utils --help: {cli * 1000:.1f} ms, "
+        f"{(cli - interpreter) * 1000:.1f} ms over a bare interpreter"
+    )
+
+    imported = set(samples[-1])
+    deferred = [
+        name
+        for name in DEFERRED_MODULES
+        if name in imported or any(m.startswith(f"{name}.") for m in imported)
+    ]
+    if deferred:
+        raise click.ClickException(
+            f"The CLI imports {', '.join(deferred)} before a command runs"
+        )
+    if import_ms > budget_ms:
+        raise click.ClickException(
+            f"Importing the CLI took {import_ms:.1f} ms, over the budget"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Synthetic stand-ins for the Ceneton census and the text archive."""
+
+import csv
+import json
+import random
+import sqlite3
+from pathlib import Path
+
+from ceneton_texts_utils.url_database import (
+    CSV_DATABASE_NAME,
+    DATABASE_FIELDS,
+    METADATA_MANIFEST_NAME,
+    URLDatabaseEntry,
+    _centeton_to_url,
+)
+
+WORDS = (
+    "de het een en van ik gy zy wy niet maer dat die wat hoe myn uw zyn haer "
+    "liefde min minnaar vader moeder zoon dochter koning vorst hof trouw eer "
+    "hemel aerde godt ziel hart traenen vreugd smart leven dood schoon bly "
+    "treurig vaderland vryheid oorlog vrede zwaerd kroon throon zee schip"
+).split()
+CHARACTERS = ["JAN", "GRIET", "KONING", "VORSTIN", "REI", "BODE", "LEANDER"]
+GENRES = ["blijspel", "treurspel", "kluchtspel", "zinnespel", "tafelspel"]
+
+CENETON_TABLE = "ceneton"
+
+
+def slug_for(number: int) -> str:
+    return f"teksten/synthetic{number:05d}.html"
+
+
+def play_html(number: int, version: int = 0, speeches: int = 200) -> bytes:
+    """A synthetic transcription, laid out like the pages on the Ceneton site."""
+    rng = random.Random(number * 1000 + version)
+    parts = [
+        "<html><head><title>Synthetic play</title></head><body>",
+        f"<center><h2>SPEL {number}</h2><p>versie {version}</p></center>",
+        "<table>",
+    ]
+    for character in CHARACTERS:
+        parts.append(f"<tr><td>{character}</td><td>{rng.choice(WORDS)}</td></tr>")
+    parts.append("</table>")
+
+    for _ in range(speeches):
+        parts.append(f"<p><b>{rng.choice(CHARACTERS)}.</b><br>")
+        for _ in range(rng.randint(2, 6)):
+            indent = "&nbsp;" * rng.choice([0, 0, 4])
+            line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 10)))
+            parts.append(f"{indent}{line.capitalize()},<br>")
+        parts.append("</p>")
+
+    parts.append("</body></html>")
+    return "\n".join(parts).encode("cp1252")
+
+
+def create_ceneton_sqlite(path: Path, rows: int, seed: int = 0):
+    """A census table with the columns used by populate_from_sqlite and
+    index_ceneton."""
+    rng = random.Random(seed)
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            f"CREATE TABLE {CENETON_TABLE} (http, nummer, auteurva, titel, jaarnr, "
+            "genre, oorspr_auteur_va, drukkerva, plaats_van_uitgave)"
+        )
+        conn.executemany(
+            f"INSERT INTO {CENETON_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    slug_for(number),
+                    number,
+                    f"Auteur {rng.randint(1, 2000)}",
+                    f"Titel {number}",
+                    rng.randint(1500, 1803),
+                    rng.choice(GENRES),
+                    None,
+                    f"Drukker {rng.randint(1, 300)}",
+                    rng.choice(["Amsterdam", "Leiden", "Haarlem", "Rotterdam"]),
+                )
+                for number in range(1, rows + 1)
+            ),
+        )
+
+
+def create_mappings_csv(path: Path, rows: int, census_rows: int, seed: int = 0):
+    """Corrections mapping census slugs to other pages, as used by
+    populate_from_mappings."""
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=["ceneton_slug", "corrected_slug"])
+        writer.writeheader()
+        for number in rng.sample(range(1, census_rows + 1), rows):
+            writer.writerow(
+                {
+                    "ceneton_slug": slug_for(number),
+                    "corrected_slug": f"teksten/corrected{number:05d}.html",
+                }
+            )
+
+
+def create_archive(
+    folder: Path,
+    entries: int,
+    with_content: int = 0,
+    base_url: str | None = None,
+    last_status: int | None = 200,
+) -> Path:
+    """An archive with an index.csv of `entries` entries, of which the first
+    `with_content` have a content.html and metadata.
+
+    URLs point at base_url (e.g. the stand-in server) if given, or at Ceneton.
+    Returns the path of the database.
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    database_path = folder / CSV_DATABASE_NAME
+
+    with open(database_path, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=DATABASE_FIELDS)
+        writer.writeheader()
+        for number in range(1, entries + 1):
+            slug = slug_for(number)
+            url = _centeton_to_url(slug)
+            if base_url:
+                url = f"{base_url}/{slug}"
+            writer.writerow(
+                {
+                    "text_id": number,
+                    "url": url,
+                    "source_slug": f"ceneton:{slug}",
+                    "last_status": last_status,
+                }
+            )
+
+    with open(folder / METADATA_MANIFEST_NAME, "w") as manifest:
+        for number in range(1, with_content + 1):
+            entry = URLDatabaseEntry(
+                text_id=number, url="", source_slug="", database_path=database_path
+            )
+            entry.archive_folder.mkdir(parents=True, exist_ok=True)
+            content = play_html(number)
+            entry.content_path.write_bytes(content)
+            record = {
+                "text_id": number,
+                "last_attempt": "2025-01-01 00:00:00+00:00",
+                "last_status": 200,
+                "content_length": len(content),
+            }
+            manifest.write(json.dumps(record) + "\n")
+
+    return database_path
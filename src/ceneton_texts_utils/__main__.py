@@ -1,16 +1,14 @@
+from contextlib import contextmanager
 from pathlib import Path
 
 import click
-from tqdm import tqdm
 
-from ceneton_texts_utils.download import download_all_urls
-from ceneton_texts_utils.indexer import index_ceneton
-from ceneton_texts_utils.url_database import (
-    URLDatabase,
-    populate_from_mappings,
-    populate_from_sqlite,
-)
-from ceneton_texts_utils.w3m import W3M
+# The CLI is started for every cron job and per-entry script, so only click and the
+# codec registry are imported up front. Each command imports the modules it needs
+# (and with them requests, yaml, tqdm and sqlite3) when it runs, which keeps
+# `--help` and commands that fail early fast. Check the cost with
+# `python -m benchmarks.startup`.
+from ceneton_texts_utils.compression import CODECS
 
 
 @click.group()
@@ -18,15 +16,67 @@ def cli():
     pass
 
 
+def metrics_options(command):
+    command = click.option(
+        "--prometheus-textfile",
+        type=click.Path(dir_okay=False),
+        default=None,
+        help="Also write the run metrics here for the node_exporter textfile collector",
+    )(command)
+    return click.option(
+        "--metrics-out",
+        type=click.Path(dir_okay=False),
+        default=None,
+        help="Write a JSON report with timings and counts of the run to this file",
+    )(command)
+
+
+@contextmanager
+def collect_metrics(
+    command: str, metrics_out: str | None, prometheus_textfile: str | None
+):
+    """Collect metrics while the block runs and write the requested reports."""
+    if not metrics_out and not prometheus_textfile:
+        yield
+        return
+
+    from ceneton_texts_utils import metrics
+    from ceneton_texts_utils.url_database import atomic_open
+
+    try:
+        with metrics.collect(command) as run_metrics:
+            yield
+    finally:
+        # Written even if the run fails or is interrupted
+        if metrics_out:
+            with atomic_open(Path(metrics_out), "w") as f:
+                f.write(run_metrics.to_json())
+        if prometheus_textfile:
+            with atomic_open(Path(prometheus_textfile), "w") as f:
+                f.write(run_metrics.to_prometheus())
+
+
 @cli.command()
 @click.argument("sqlite_path", type=click.Path(exists=True))
 @click.option(
     "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
 )
 @click.option("--create", is_flag=True, default=False)
-def sqlite(sqlite_path: str, database_folder: str, create: bool):
-    database = URLDatabase(f"{database_folder}/index.csv", create_if_missing=create)
-    populate_from_sqlite(database, sqlite_path)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="List the entries that would be added without changing the database",
+)
+def sqlite(sqlite_path: str, database_folder: str, create: bool, dry_run: bool):
+    from ceneton_texts_utils.url_database import (
+        URLDatabase,
+        find_database,
+        populate_from_sqlite,
+    )
+
+    database = URLDatabase(find_database(database_folder), create_if_missing=create)
+    populate_from_sqlite(database, sqlite_path, dry_run=dry_run)
 
 
 @cli.command()
@@ -35,9 +85,21 @@ def sqlite(sqlite_path: str, database_folder: str, create: bool):
     "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
 )
 @click.option("--create", is_flag=True, default=False)
-def mappings(csv_path: str, database_folder: str, create: bool):
-    database = URLDatabase(f"{database_folder}/index.csv", create_if_missing=create)
-    populate_from_mappings(database, csv_path)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="List the entries that would change without changing the database",
+)
+def mappings(csv_path: str, database_folder: str, create: bool, dry_run: bool):
+    from ceneton_texts_utils.url_database import (
+        URLDatabase,
+        find_database,
+        populate_from_mappings,
+    )
+
+    database = URLDatabase(find_database(database_folder), create_if_missing=create)
+    populate_from_mappings(database, csv_path, dry_run=dry_run)
 
 
 @cli.command()
@@ -51,9 +113,144 @@ def mappings(csv_path: str, database_folder: str, create: bool):
     default=0,
     help="Skip entries that were last_checked within this many minutes",
 )
-def download(database_folder: str, min_interval_minutes: int):
-    database = URLDatabase(f"{database_folder}/index.csv")
-    download_all_urls(database, min_interval_minutes)
+@click.option(
+    "--schedule",
+    is_flag=True,
+    default=False,
+    help="Only check entries that are due according to how often they change",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of concurrent download workers",
+)
+@click.option(
+    "--max-in-flight",
+    type=click.IntRange(min=1),
+    default=2,
+    help="Maximum concurrent requests to a single host",
+)
+@click.option(
+    "--requests-per-second",
+    type=click.FloatRange(min=0),
+    default=2.0,
+    help="Maximum requests per second to a single host (0 for no limit)",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Continue an interrupted run where it stopped",
+)
+@click.option(
+    "--dedupe",
+    is_flag=True,
+    default=False,
+    help="Store content in the content-addressed blob store",
+)
+@click.option(
+    "--compress",
+    type=click.Choice(["none", *CODECS]),
+    default="none",
+    help="Compress downloaded content with this codec",
+)
+@click.option(
+    "--shard",
+    type=str,
+    default=None,
+    help="Only download shard i/N of the archive, alongside other workers",
+)
+@click.option(
+    "--lease-timeout",
+    type=click.FloatRange(min=1),
+    default=600,
+    help="Seconds without a heartbeat before another worker may take over a shard",
+)
+@metrics_options
+def download(
+    database_folder: str,
+    min_interval_minutes: int,
+    schedule: bool,
+    workers: int,
+    max_in_flight: int,
+    requests_per_second: float,
+    resume: bool,
+    dedupe: bool,
+    compress: str,
+    shard: str | None,
+    lease_timeout: float,
+    metrics_out: str | None,
+    prometheus_textfile: str | None,
+):
+    from ceneton_texts_utils.blob_store import BlobStore
+    from ceneton_texts_utils.compression import get_codec
+    from ceneton_texts_utils.download import (
+        HostRateLimiter,
+        download_all_urls,
+        download_shard,
+    )
+    from ceneton_texts_utils.schedule import RecrawlPolicy
+    from ceneton_texts_utils.shards import Shard
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    with collect_metrics("download", metrics_out, prometheus_textfile):
+        # Shard workers leave the journal of the database to an unsharded run
+        database = URLDatabase(
+            find_database(database_folder), replay_journal=shard is None
+        )
+        limiter = HostRateLimiter(
+            max_in_flight=max_in_flight,
+            requests_per_second=requests_per_second or None,
+        )
+        kwargs = dict(
+            min_interval_minutes=min_interval_minutes,
+            workers=workers,
+            limiter=limiter,
+            blob_store=BlobStore.for_database(database) if dedupe else None,
+            codec=get_codec(compress),
+            policy=RecrawlPolicy() if schedule else None,
+        )
+        if shard is None:
+            download_all_urls(database, resume=resume, **kwargs)
+        else:
+            download_shard(
+                database,
+                Shard.for_database(database, shard),
+                lease_timeout=lease_timeout,
+                **kwargs,
+            )
+
+
+@cli.command("merge-shards")
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "--partial",
+    is_flag=True,
+    default=False,
+    help="Also merge shards that stopped before completing",
+)
+@click.option(
+    "--lease-timeout",
+    type=click.FloatRange(min=1),
+    default=600,
+    help="Seconds without a heartbeat before a shard is considered stopped",
+)
+def merge_shards_command(database_folder: str, partial: bool, lease_timeout: float):
+    """Fold the results of a sharded download into the database."""
+    from ceneton_texts_utils.shards import SHARDS_FOLDER_NAME, merge_shards
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+    merge_shards(
+        database,
+        Path(database_folder) / SHARDS_FOLDER_NAME,
+        partial=partial,
+        timeout=lease_timeout,
+    )
 
 
 @cli.command()
@@ -68,17 +265,76 @@ def download(database_folder: str, min_interval_minutes: int):
     default=None,
     help="Comma-separated list of entry IDs",
 )
-def w3m(database_folder: str, entry_ids: list[int] | None):
-    database = URLDatabase(f"{database_folder}/index.csv")
-    w3m = W3M()
+@click.option(
+    "--engine",
+    type=click.Choice(["w3m", "builtin"]),
+    default="w3m",
+    help="Convert with the w3m binary or the builtin html.parser converter",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Convert entries even if their text is up to date",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of entries to convert in parallel",
+)
+@click.option(
+    "--compress",
+    type=click.Choice(["none", *CODECS]),
+    default="none",
+    help="Compress content.txt with this codec",
+)
+@click.option(
+    "--changed-since",
+    type=str,
+    default=None,
+    help="Only process entries changed by this download run or later ones "
+    "(a run id, or last)",
+)
+@metrics_options
+def w3m(
+    database_folder: str,
+    entry_ids: list[int] | None,
+    engine: str,
+    force: bool,
+    jobs: int,
+    compress: str,
+    changed_since: str | None,
+    metrics_out: str | None,
+    prometheus_textfile: str | None,
+):
+    from ceneton_texts_utils.changeset import changed_entries
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+    from ceneton_texts_utils.w3m import CONVERTERS, convert_entries
+
+    with collect_metrics("w3m", metrics_out, prometheus_textfile):
+        database = URLDatabase(find_database(database_folder))
+        w3m = CONVERTERS[engine]()
 
-    if entry_ids:
-        entries = [database.get_entry(entry_id) for entry_id in entry_ids]
-    else:
-        entries = [e for e in database if e.content_path.exists()]
+        if entry_ids:
+            entries = [database.get_entry(entry_id) for entry_id in entry_ids]
+        elif changed_since:
+            text_ids = changed_entries(database, changed_since)
+            entries = [database.get_entry(text_id) for text_id in sorted(text_ids)]
+            entries = [e for e in entries if e and e.content_path.exists()]
+        else:
+            entries = [e for e in database if e.content_path.exists()]
 
-    for entry in tqdm(entries):
-        w3m.convert_entry(entry)
+        converted, errors = convert_entries(
+            w3m, entries, jobs=jobs, force=force, compress=compress
+        )
+
+        skipped = len(entries) - converted - len(errors)
+        print(f"Converted {converted} entries, {skipped} up to date")
+        for text_id, error in sorted(errors.items()):
+            print(f"Error converting {text_id}: {error}")
+        database.metadata_store.sync(database)
 
 
 @cli.command()
@@ -88,12 +344,372 @@ def w3m(database_folder: str, entry_ids: list[int] | None):
     "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
 )
 @click.option("--database-table", type=str, default=None)
+@click.option(
+    "--changed-since",
+    type=str,
+    default=None,
+    help="Only update the rows of entries checked by this download run or later "
+    "ones (a run id, or last)",
+)
+@metrics_options
 def index(
-    sqlite_path: str, output_path: str, database_folder: str, database_table: str | None
+    sqlite_path: str,
+    output_path: str,
+    database_folder: str,
+    database_table: str | None,
+    changed_since: str | None,
+    metrics_out: str | None,
+    prometheus_textfile: str | None,
+):
+    """Resolve the census rows to archived texts and write them to OUTPUT_PATH,
+    a CSV file or, with a .sqlite, .sqlite3 or .db suffix, an SQLite database."""
+    from ceneton_texts_utils.indexer import index_ceneton
+    from ceneton_texts_utils.url_database import find_database
+
+    with collect_metrics("index", metrics_out, prometheus_textfile):
+        database_path = find_database(database_folder)
+        index_ceneton(
+            Path(sqlite_path),
+            database_path,
+            Path(output_path),
+            database_table,
+            changed_since=changed_since,
+        )
+
+
+@cli.command("import-csv")
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+def import_csv(database_folder: str):
+    """Create the SQLite database from index.csv."""
+    from ceneton_texts_utils.url_database import (
+        CSV_DATABASE_NAME,
+        SQLITE_DATABASE_NAME,
+        URLDatabase,
+    )
+
+    sqlite_path = Path(database_folder) / SQLITE_DATABASE_NAME
+    if sqlite_path.exists():
+        raise click.ClickException(f"{sqlite_path} already exists")
+
+    database = URLDatabase(Path(database_folder) / CSV_DATABASE_NAME)
+    database.export_database(sqlite_path)
+
+
+@cli.command("export-csv")
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+def export_csv(database_folder: str):
+    """Regenerate index.csv from the SQLite database."""
+    from ceneton_texts_utils.url_database import (
+        CSV_DATABASE_NAME,
+        SQLITE_DATABASE_NAME,
+        URLDatabase,
+    )
+
+    sqlite_path = Path(database_folder) / SQLITE_DATABASE_NAME
+    if not sqlite_path.exists():
+        raise click.ClickException(f"{sqlite_path} does not exist")
+
+    database = URLDatabase(sqlite_path)
+    database.export_database(Path(database_folder) / CSV_DATABASE_NAME)
+
+
+@cli.command("sync-metadata")
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "--rebuild",
+    is_flag=True,
+    default=False,
+    help="Rebuild the manifest from the metadata.yml files",
+)
+@click.option(
+    "--export-all",
+    is_flag=True,
+    default=False,
+    help="Rewrite every metadata.yml file, not just the changed ones",
+)
+def sync_metadata(database_folder: str, rebuild: bool, export_all: bool):
+    """Export metadata.yml files from the metadata manifest."""
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+    if rebuild:
+        database.metadata_store.load_yaml(database)
+    database.metadata_store.sync(database, export_all=export_all)
+
+
+@cli.command()
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "--prune",
+    is_flag=True,
+    default=False,
+    help="Also remove blobs that are no longer used by any entry",
+)
+def dedupe(database_folder: str, prune: bool):
+    """Move existing content into the content-addressed blob store."""
+    from ceneton_texts_utils.blob_store import BlobStore, dedupe_archive
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+    blob_store = BlobStore.for_database(database)
+
+    saved = dedupe_archive(database, blob_store)
+    print(f"Saved {saved} bytes by deduplicating content")
+
+    if prune:
+        removed = blob_store.prune()
+        print(f"Removed {removed} unused blobs")
+
+
+@cli.command()
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "--codec",
+    type=click.Choice(["none", *CODECS]),
+    required=True,
+    help="Codec to store files with, or none to decompress",
+)
+@click.option(
+    "--text/--no-text",
+    default=True,
+    help="Also convert content.txt files",
+)
+def compress(database_folder: str, codec: str, text: bool):
+    """Convert the stored content of an existing archive to another codec."""
+    from ceneton_texts_utils.compression import get_codec
+    from ceneton_texts_utils.storage import compress_archive
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+
+    converted, before, after = compress_archive(
+        database, get_codec(codec), include_text=text
+    )
+    print(f"Converted {converted} files from {before} to {after} bytes")
+
+
+@cli.command()
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Pack file to write, archive.ctpack in the database folder by default",
+)
+@click.option(
+    "--codec",
+    type=click.Choice(["none", *CODECS]),
+    default="none",
+    help="Compress every member of the pack with this codec",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="Rewrite the pack instead of appending the entries that changed",
+)
+def pack(database_folder: str, output: str | None, codec: str, full: bool):
+    """Write the whole archive to a single pack file."""
+    from ceneton_texts_utils.compression import get_codec
+    from ceneton_texts_utils.pack import PACK_NAME, pack_archive
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+    pack_path = Path(output) if output else Path(database_folder) / PACK_NAME
+
+    written, written_bytes = pack_archive(
+        database, pack_path, get_codec(codec), full=full
+    )
+    print(f"Wrote {written} members ({written_bytes} bytes) to {pack_path}")
+
+
+@cli.command()
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of processes hashing files, one per CPU by default",
+)
+@click.option(
+    "--since",
+    type=str,
+    default=None,
+    help="Only verify content changed since this ISO date or age (e.g. 24h, 7d)",
+)
+def verify(database_folder: str, jobs: int | None, since: str | None):
+    """Check archived content against the sha256 and length in its metadata."""
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+    from ceneton_texts_utils.verify import KINDS, parse_since, verify_archive
+
+    database = URLDatabase(find_database(database_folder))
+
+    problems = verify_archive(
+        database, jobs=jobs, since=parse_since(since) if since else None
+    )
+    for problem in problems:
+        print(f"{problem.text_id:>5} {problem.kind:<9} {problem.detail}")
+
+    counts = {kind: sum(p.kind == kind for p in problems) for kind in KINDS}
+    print(", ".join(f"{count} {kind}" for kind, count in counts.items()))
+    if problems:
+        raise click.ClickException(f"Found {len(problems)} problems in the archive")
+
+
+@cli.command()
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option("--host", type=str, default="127.0.0.1")
+@click.option("--port", type=click.IntRange(min=0), default=8080)
+@click.option(
+    "--cache-mb",
+    type=click.IntRange(min=0),
+    default=256,
+    help="Size of the in-memory cache of content and text",
+)
+@click.option(
+    "--metadata",
+    "metadata_path",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Output of the index command, to include author, title, year and genre",
+)
+def serve(
+    database_folder: str,
+    host: str,
+    port: int,
+    cache_mb: int,
+    metadata_path: str | None,
 ):
-    database_path = Path(database_folder) / "index.csv"
+    """Serve the archive read-only over a local HTTP API."""
+    from ceneton_texts_utils.serve import ArchiveService, serve_archive
+    from ceneton_texts_utils.url_database import find_database
+
+    service = ArchiveService(
+        find_database(database_folder),
+        cache_bytes=cache_mb * 1024 * 1024,
+        text_metadata_path=Path(metadata_path) if metadata_path else None,
+    )
+    server = serve_archive(service, host, port)
+    host, port = server.server_address[:2]
+    print(f"Serving {len(service.database.database_entries)} entries at {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@cli.command("storage-report")
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option("--sample-size", type=click.IntRange(min=1), default=200)
+def storage_report_command(database_folder: str, sample_size: int):
+    """Compare compression ratio and read throughput of the available codecs."""
+    from ceneton_texts_utils.storage import storage_report
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+
+    print(f"{'codec':<8} {'ratio':>7} {'write MB/s':>11} {'read MB/s':>10}")
+    for report in storage_report(database, sample_size):
+        print(
+            f"{report.codec:<8} {report.ratio:>7.2f} "
+            f"{report.write_mb_per_second:>11.1f} {report.read_mb_per_second:>10.1f}"
+        )
+
+
+@cli.command("search-index")
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes used to tokenize texts",
+)
+@click.option(
+    "--merge",
+    is_flag=True,
+    default=False,
+    help="Merge all segments into one after updating",
+)
+def search_index(database_folder: str, jobs: int, merge: bool):
+    """Update the full-text index with new and changed texts."""
+    from ceneton_texts_utils.search import SearchIndex
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+    index = SearchIndex.for_database(database)
+
+    indexed, removed = index.update(database, jobs=jobs)
+    if merge and len(index.manifest["segments"]) > 1:
+        index.merge()
+    index.close()
+
+    print(f"Indexed {indexed} texts, removed {removed}")
+
+
+@cli.command()
+@click.argument("query")
+@click.option(
+    "--database-folder", type=click.Path(exists=True, file_okay=False), default="."
+)
+@click.option(
+    "--metadata",
+    "metadata_path",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Output of the index command, to show author, title, year and genre",
+)
+@click.option("--limit", type=click.IntRange(min=1), default=20)
+def search(query: str, database_folder: str, metadata_path: str | None, limit: int):
+    """Search the converted texts.
+
+    QUERY may contain words, "quoted phrases" and prefixes such as `liefd*`.
+    """
+    from ceneton_texts_utils.search import SearchIndex, load_text_metadata
+    from ceneton_texts_utils.url_database import URLDatabase, find_database
+
+    database = URLDatabase(find_database(database_folder))
+    index = SearchIndex.for_database(database)
+    metadata = load_text_metadata(metadata_path) if metadata_path else {}
+
+    results = index.search(query)
+    index.close()
 
-    index_ceneton(Path(sqlite_path), database_path, Path(output_path), database_table)
+    ranked = sorted(results.items(), key=lambda r: (-r[1], r[0]))
+    for text_id, hits in ranked[:limit]:
+        row = metadata.get(text_id)
+        if row is None:
+            print(f"{text_id:>5} {hits:>5}")
+        else:
+            print(
+                f"{text_id:>5} {hits:>5}  {row['auteurva']} - {row['titel']} "
+                f"({row['jaarnr']}, {row['genre']})"
+            )
+    print(f"{len(results)} matching texts")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import hashlib
+import os
+from pathlib import Path
+
+from tqdm import tqdm
+
+from ceneton_texts_utils.compression import open_stored, stored_codec
+from ceneton_texts_utils.url_database import URLDatabase
+
+BLOB_STORE_NAME = ".blobs"
+
+
+class BlobStore:
+    """Content-addressed store for archived files, keyed by sha256.
+
+    Entry files are hardlinked to their blob, so byte-identical pages share a single
+    copy on disk. Archive files are always replaced by rename and never written in
+    place, so saving an entry never changes a blob shared with other entries.
+    """
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+
+    @classmethod
+    def for_database(cls, database: URLDatabase) -> "BlobStore":
+        return cls(database.database_path.parent / BLOB_STORE_NAME)
+
+    def blob_path(self, sha256: str, suffix: str = "") -> Path:
+        return self.root / sha256[:2] / f"{sha256}{suffix}"
+
+    def adopt(self, path: Path, sha256: str) -> int:
+        """Link path to the blob for sha256, adding it to the store if it is new.
+
+        sha256 is the hash of the uncompressed content. Compressed files are stored
+        as separate blobs with the codec suffix.
+
+        Returns the number of bytes saved, which is the size of path if an identical
+        blob was already stored.
+        """
+        codec = stored_codec(path)
+        blob_path = self.blob_path(sha256, codec.suffix if codec else "")
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(path, blob_path)
+                return 0
+            except FileExistsError:
+                # Another worker stored the same content first
+                pass
+
+        if os.path.samefile(path, blob_path):
+            return 0
+
+        size = path.stat().st_size
+        tmp_path = path.with_name(f".{path.name}.link")
+        os.link(blob_path, tmp_path)
+        os.replace(tmp_path, path)
+        return size
+
+    def prune(self) -> int:
+        """Remove blobs no longer linked from any entry, returning the count."""
+        removed = 0
+        for blob_path in self.root.glob("*/*"):
+            if blob_path.stat().st_nlink == 1:
+                blob_path.unlink()
+                removed += 1
+        return removed
+
+
+def _file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open_stored(path) as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def dedupe_archive(database: URLDatabase, blob_store: BlobStore) -> int:
+    """Move the content of every entry in an existing archive into the blob store.
+
+    Files are hashed before they are linked, and entries whose content no longer
+    matches the sha256 in their metadata are left alone. Returns the number of
+    bytes saved.
+    """
+    saved = 0
+    mismatched = []
+    for entry in tqdm(list(database)):
+        metadata = entry.metadata
+        if metadata is None or metadata.sha256 is None:
+            continue
+        if not entry.content_path.exists():
+            continue
+
+        if _file_sha256(entry.content_path) != metadata.sha256:
+            mismatched.append(entry.text_id)
+            continue
+
+        saved += blob_store.adopt(entry.content_path, metadata.sha256)
+
+    for text_id in mismatched:
+        print(f"Skipping {text_id} because its content does not match its sha256")
+
+    return saved
@@ -0,0 +1,96 @@
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+from ceneton_texts_utils.shards import Shard
+from ceneton_texts_utils.url_database import URLDatabase, URLDatabaseJournal
+
+CHANGESETS_FOLDER_NAME = "changesets"
+
+# What a crawl found for each entry it checked
+ADDED = "added"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+RESULTS = (ADDED, CHANGED, UNCHANGED, FAILED)
+
+# The results that leave new content in the archive
+CONTENT_CHANGED = (ADDED, CHANGED)
+
+LAST_RUN = "last"
+
+
+def run_id(run_started: datetime) -> str:
+    """Identify a crawl by the time it started, so run ids sort by time."""
+    return run_started.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def changesets_folder(database: URLDatabase) -> Path:
+    return database.database_path.parent / CHANGESETS_FOLDER_NAME
+
+
+def open_changeset(
+    database: URLDatabase, run_started: datetime, shard: Shard | None = None
+) -> URLDatabaseJournal:
+    """Open the changeset of a crawl for appending.
+
+    A changeset is a journal of the result of every entry the crawl checked. It is
+    kept after the crawl completes. A resumed crawl, or a worker taking over a
+    shard, has the same start time and continues the same changeset.
+    """
+    name = run_id(run_started)
+    if shard is not None:
+        name = f"{name}-{shard.name}"
+    path = changesets_folder(database) / f"{name}.jsonl"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return URLDatabaseJournal(path, run_started, append=True)
+
+
+def list_runs(database: URLDatabase) -> dict[str, list[Path]]:
+    """The changeset files of every crawl by run id, oldest first.
+
+    A sharded crawl has a changeset per shard, all with the run id of the time the
+    first shard started.
+    """
+    runs: dict[str, list[Path]] = {}
+    for path in sorted(changesets_folder(database).glob("*.jsonl")):
+        runs.setdefault(path.stem.partition("-")[0], []).append(path)
+    return runs
+
+
+def read_changes(database: URLDatabase, since: str) -> dict[int, set[str]]:
+    """The results of every entry checked by the run since or any later run.
+
+    since is a run id, or "last" for the most recent run. Changesets of crawls that
+    were interrupted are included, as their changes are already in the archive.
+    """
+    runs = list_runs(database)
+    assert runs, f"No changesets in {changesets_folder(database)}"
+    if since == LAST_RUN:
+        since = list(runs)[-1]
+    assert since in runs, f"No changeset for run {since}, try one of {list(runs)}"
+
+    results: dict[int, set[str]] = {}
+    for run, paths in runs.items():
+        if run < since:
+            continue
+        for path in paths:
+            _, updates = URLDatabaseJournal.read(path)
+            for text_id, values in updates:
+                results.setdefault(text_id, set()).add(values["result"])
+    return results
+
+
+def changed_entries(
+    database: URLDatabase, since: str, results: tuple[str, ...] = CONTENT_CHANGED
+) -> set[int]:
+    """The text_ids of entries with any of results in the run since or later."""
+    return {
+        text_id
+        for text_id, found in read_changes(database, since).items()
+        if found.intersection(results)
+    }
+
+
+def summarize(results: Counter) -> str:
+    return ", ".join(f"{results[result]} {result}" for result in RESULTS)
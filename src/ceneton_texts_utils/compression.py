@@ -0,0 +1,116 @@
+import bz2
+import gzip
+import lzma
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+try:
+    # Python 3.14+
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    suffix: str
+    # Opens a compressed file for reading
+    open: Callable[[Path], BinaryIO]
+    # Wraps an open binary file so that writes to it are compressed. Closing the
+    # wrapper must not close the underlying file.
+    writer: Callable[[BinaryIO], BinaryIO]
+
+    def path_for(self, path: Path) -> Path:
+        return path.with_name(path.name + self.suffix)
+
+
+CODECS: dict[str, Codec] = {
+    "gzip": Codec(
+        "gzip",
+        ".gz",
+        lambda path: gzip.open(path, "rb"),
+        # No timestamp in the header, so identical content compresses identically
+        lambda f: gzip.GzipFile(fileobj=f, mode="wb", mtime=0),
+    ),
+    "bz2": Codec(
+        "bz2",
+        ".bz2",
+        lambda path: bz2.open(path, "rb"),
+        lambda f: bz2.BZ2File(f, "wb"),
+    ),
+    "lzma": Codec(
+        "lzma",
+        ".xz",
+        lambda path: lzma.open(path, "rb"),
+        lambda f: lzma.LZMAFile(f, "wb"),
+    ),
+}
+
+if zstd is not None:
+    CODECS["zstd"] = Codec(
+        "zstd",
+        ".zst",
+        lambda path: zstd.open(path, "rb"),
+        lambda f: zstd.ZstdFile(f, "wb"),
+    )
+elif zstandard is not None:
+    CODECS["zstd"] = Codec(
+        "zstd",
+        ".zst",
+        lambda path: zstandard.open(path, "rb"),
+        lambda f: zstandard.ZstdCompressor().stream_writer(f, closefd=False),
+    )
+
+
+def get_codec(name: str | None) -> Codec | None:
+    """Look up a codec by name. "none" and None mean uncompressed storage."""
+    if name is None or name == "none":
+        return None
+    assert name in CODECS, f"Unknown or unavailable codec {name}"
+    return CODECS[name]
+
+
+def stored_codec(path: Path) -> Codec | None:
+    """Return the codec a stored file is compressed with, going by its suffix."""
+    for codec in CODECS.values():
+        if path.name.endswith(codec.suffix):
+            return codec
+    return None
+
+
+def stored_variants(path: Path) -> list[Path]:
+    """All the names a file can be stored under: plain or with a codec suffix."""
+    return [path] + [codec.path_for(path) for codec in CODECS.values()]
+
+
+def stored_path(path: Path) -> Path:
+    """Return the path a file is actually stored under, compressed or not.
+
+    Returns the uncompressed path if no variant exists.
+    """
+    for variant in stored_variants(path):
+        if variant.exists():
+            return variant
+    return path
+
+
+def open_stored(path: Path) -> BinaryIO:
+    """Open a stored file for reading, decompressing it if needed."""
+    codec = stored_codec(path)
+    if codec is None:
+        return open(path, "rb")
+    return codec.open(path)
+
+
+def remove_other_variants(path: Path, keep: Path):
+    for variant in stored_variants(path):
+        if variant != keep:
+            variant.unlink(missing_ok=True)
@@ -1,17 +1,43 @@
-import hashlib
 import signal
 import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from ceneton_texts_utils import metrics
+from ceneton_texts_utils.blob_store import BlobStore
+from ceneton_texts_utils.changeset import (
+    ADDED,
+    CHANGED,
+    FAILED,
+    UNCHANGED,
+    open_changeset,
+    run_id,
+    summarize,
+)
+from ceneton_texts_utils.compression import Codec
+from ceneton_texts_utils.schedule import RecrawlPolicy, due_entries
+from ceneton_texts_utils.shards import Shard, ShardLease
 from ceneton_texts_utils.url_database import (
     URLDatabase,
     URLDatabaseEntry,
     URLDatabaseEntryMetadata,
+    URLDatabaseJournal,
+    set_metadata_store,
 )
 
+CHUNK_SIZE = 64 * 1024
+
+# Seconds to wait for a connection, and for each read of the response after that
+REQUEST_TIMEOUT = (10, 60)
+
 
 @contextmanager
 def shutdown_hook(callback):
@@ -38,85 +64,369 @@ def shutdown_hook(callback):
         signal.signal(signal.SIGTERM, original_sigterm)
 
 
-def download_url(entry: URLDatabaseEntry):
+class HostRateLimiter:
+    """Per-host politeness limits shared by all download workers.
+
+    Args:
+        max_in_flight: Maximum number of concurrent requests to a single host
+        requests_per_second: Maximum request rate to a single host. Use None to
+            disable rate limiting.
+
+    """
+
+    def __init__(self, max_in_flight: int = 2, requests_per_second: float | None = 2):
+        assert max_in_flight > 0, "max_in_flight must be positive"
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+
+        self._lock = threading.Lock()
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._next_slot: dict[str, float] = {}
+
+    @contextmanager
+    def limit(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_in_flight)
+                self._semaphores[host] = semaphore
+
+        with semaphore:
+            self._wait_for_slot(host)
+            yield
+
+    def _wait_for_slot(self, host: str):
+        if not self.requests_per_second:
+            return
+
+        # Reserve the next free slot for this host, then sleep outside the lock
+        interval = 1 / self.requests_per_second
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+@contextmanager
+def _limited(limiter: HostRateLimiter | None, url: str):
+    if limiter is None:
+        yield
+    else:
+        with limiter.limit(url):
+            yield
+
+
+def create_session(pool_size: int = 10) -> requests.Session:
+    """Create a keep-alive session with a connection pool sized for the workers.
+
+    Args:
+        pool_size: Maximum number of pooled connections kept open per host
+
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _conditional_headers(metadata: URLDatabaseEntryMetadata) -> dict[str, str]:
+    headers = {}
+    if metadata.etag:
+        headers["If-None-Match"] = metadata.etag
+    if metadata.last_modified:
+        headers["If-Modified-Since"] = metadata.last_modified
+    return headers
+
+
+def _record_failure(
+    entry: URLDatabaseEntry,
+    metadata: URLDatabaseEntryMetadata,
+    status: int,
+    reason: str,
+) -> tuple[URLDatabaseEntryMetadata, str]:
+    print(f"Error {reason} when checking {entry.url}")
+    metrics.count("entries_total", result="failed")
+    metadata.last_status = status
+    # Recorded for entries never downloaded too, so their retries back off. Those
+    # stay in the manifest, as sync only exports metadata.yml next to content
+    metadata.failures += 1
+    entry.save_metadata(metadata)
+    return metadata, FAILED
+
+
+def download_url(
+    entry: URLDatabaseEntry,
+    limiter: HostRateLimiter | None = None,
+    session: requests.Session | None = None,
+    blob_store: BlobStore | None = None,
+    codec: Codec | None = None,
+) -> tuple[URLDatabaseEntryMetadata, str] | None:
+    """Check an entry for new content, returning its metadata and the result.
+
+    The result is one of the changeset results. Returns None for skipped entries.
+    Requests that fail without a response, including timeouts, are recorded as
+    failures with a last_status of 0.
+    """
     if entry.skip:
         print(f"Skipping {entry.url} because it is marked as skipped")
+        metrics.count("entries_skipped_total", reason="marked")
         return
 
+    http = session or requests
+
     metadata = entry.metadata
     if metadata is None:
         metadata = URLDatabaseEntryMetadata(last_attempt=0, last_status=0)
 
-    metadata.last_attempt = datetime.now(tz=timezone.utc)
+    attempt = datetime.now(tz=timezone.utc)
+    metadata.last_attempt = attempt
 
-    if metadata.etag:
-        response = requests.head(entry.url)
-        if response.status_code < 300:
-            etag = response.headers.get("ETag")
-            if etag == metadata.etag:
+    # Revalidate with a single conditional GET if we have a previous copy
+    has_copy = metadata.sha256 is not None and entry.content_path.exists()
+    headers = _conditional_headers(metadata) if has_copy else {}
+
+    previous_sha256 = metadata.sha256
+
+    try:
+        with (
+            _limited(limiter, entry.url),
+            http.get(
+                entry.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT
+            ) as response,
+        ):
+            # Time until the headers arrived, the body is timed as part of saving it
+            metrics.observe("request_seconds", response.elapsed.total_seconds())
+            metrics.count("responses_total", status=str(response.status_code))
+
+            if response.status_code == 304 or (
+                response.status_code == 200
+                and has_copy
+                and metadata.etag
+                and response.headers.get("ETag") == metadata.etag
+            ):
                 print(f"Skipping {entry.url} because it is already up to date")
-                return metadata
+                metrics.count("entries_total", result="unchanged")
+                # A successful revalidation clears any earlier failures
+                if metadata.failures or metadata.last_status != 200:
+                    metadata.failures = 0
+                    metadata.last_status = 200
+                    entry.save_metadata(metadata)
+                return metadata, UNCHANGED
 
-        else:
-            print(f"Error {response.status_code} when checking {entry.url}")
-            metadata.last_status = response.status_code
-            entry.save_metadata(metadata)
-            return metadata
+            if response.status_code != 200:
+                return _record_failure(
+                    entry, metadata, response.status_code, str(response.status_code)
+                )
 
-    response = requests.get(entry.url)
-    metadata.last_status = response.status_code
-    if response.status_code == 200:
-        metadata.etag = response.headers.get("ETag")
-        metadata.last_modified = response.headers.get("Last-Modified")
-        metadata.content_length = int(response.headers.get("Content-Length", 0))
+            metadata.last_status = response.status_code
+            metadata.etag = response.headers.get("ETag")
+            metadata.last_modified = response.headers.get("Last-Modified")
+            metadata.failures = 0
 
-        content = response.content
-        metadata.sha256 = hashlib.sha256(content).hexdigest()
+            chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+            entry.save_content_stream(chunks, metadata, codec)
+    except requests.RequestException as e:
+        metrics.count("responses_total", status="error")
+        # The stored copy and metadata are untouched by a failed transfer, so the
+        # validators of this response must not be recorded
+        metadata = entry.metadata or URLDatabaseEntryMetadata(
+            last_attempt=attempt, last_status=0
+        )
+        metadata.last_attempt = attempt
+        return _record_failure(entry, metadata, 0, type(e).__name__)
 
-        entry.save_metadata(metadata)
-        entry.save_content(content)
+    if blob_store is not None:
+        blob_store.adopt(entry.content_path, metadata.sha256)
 
-    return metadata
+    metrics.count("bytes_downloaded_total", metadata.content_length)
+    if previous_sha256 is None:
+        metrics.count("entries_total", result="new")
+        return metadata, ADDED
+    elif previous_sha256 == metadata.sha256:
+        metrics.count("entries_total", result="unchanged")
+        return metadata, UNCHANGED
+    else:
+        metrics.count("entries_total", result="changed")
+        return metadata, CHANGED
 
 
-def download_all_urls(database: URLDatabase, min_interval_minutes: int = 0):
+def download_all_urls(
+    database: URLDatabase,
+    min_interval_minutes: int = 0,
+    workers: int = 1,
+    limiter: HostRateLimiter | None = None,
+    resume: bool = False,
+    blob_store: BlobStore | None = None,
+    codec: Codec | None = None,
+    policy: RecrawlPolicy | None = None,
+    shard: Shard | None = None,
+    cancel: threading.Event | None = None,
+):
     """Download all URLs in the database, optionally skipping recently checked entries.
 
+    Downloads run on a pool of worker threads, but all database updates happen on
+    the calling thread so the database only ever has a single writer. Updates are
+    recorded in the database journal as they happen and the database itself is
+    only saved once the run completes, when the metadata.yml files of the entries
+    that changed are exported from the metadata manifest.
+
+    The result of every entry checked is recorded in the changeset of the run,
+    which is kept so that later stages can process only the entries that changed.
+
     Args:
         database: The URL database to process
         min_interval_minutes: Skip entries that were last_checked within this many
             minutes. Use 0 to disable this filtering (default).
+        workers: Number of concurrent download workers
+        limiter: Optional per-host politeness limits shared by all workers
+        resume: Continue an interrupted run, skipping the entries it already
+            checked
+        blob_store: Optional content-addressed store to deduplicate content in
+        codec: Optional codec to compress downloaded content with
+        policy: Only check the entries this recrawl policy says are due, most
+            overdue first
+        shard: Only check the entries in this shard. Updates are recorded in the
+            shard results instead of the database, see `download_shard`.
+        cancel: Stop as soon as this event is set. Downloads already running are
+            left to finish, but nothing more is recorded and the journal is kept.
 
     """
-    with shutdown_hook(lambda: database.save_database()):
-        now = datetime.now(tz=timezone.utc)
+    assert workers > 0, "workers must be positive"
+
+    now = datetime.now(tz=timezone.utc)
+    resume_from = None
+    if resume:
+        if database.interrupted_run is None:
+            print("No interrupted run to resume, starting a new run")
+        else:
+            resume_from = now = database.interrupted_run
+            print(f"Resuming run started at {resume_from}")
+
+    if shard is not None:
+        # All shards of a run share the start time of the first, and so its run id
+        now = shard.run_started(now)
+
+    # Entries a previous worker on this shard already checked
+    shard_done: set[int] = set()
+    if shard is not None and shard.results_path.exists():
+        run_started, updates = URLDatabaseJournal.read(shard.results_path)
+        now = run_started or now
+        shard_done = {text_id for text_id, _ in updates}
+        print(f"Continuing {shard.name}, {len(shard_done)} entries already checked")
+
+    changeset = open_changeset(database, now, shard)
+    results = Counter()
+
+    def sync_journal():
+        if database.journal is not None:
+            database.journal.sync()
+        changeset.sync()
+
+    if shard is None:
+        database.start_journal(now)
+    else:
+        database.start_journal(now, journal_path=shard.results_path, append=True)
+
+    with (
+        shutdown_hook(sync_journal),
+        create_session(pool_size=workers) as session,
+    ):
         cutoff_time = (
             now - timedelta(minutes=min_interval_minutes)
             if min_interval_minutes > 0
             else None
         )
 
-        written = 0
         skipped_recent = 0
+        skipped_resumed = 0
+        skipped_not_due = 0
+
+        candidates = list(database)
+        if shard is not None:
+            candidates = [
+                e
+                for e in candidates
+                if shard.contains(e) and e.text_id not in shard_done
+            ]
+        if policy is not None:
+            candidates, skipped_not_due = due_entries(candidates, policy, now)
+
+        def pending_entries():
+            nonlocal skipped_recent, skipped_resumed
+            for entry in candidates:
+                # Skip entries the interrupted run already got to
+                if (
+                    resume_from
+                    and entry.last_checked
+                    and entry.last_checked >= resume_from
+                ):
+                    skipped_resumed += 1
+                    continue
+
+                # Skip entries that were checked recently
+                if (
+                    cutoff_time
+                    and entry.last_checked
+                    and entry.last_checked > cutoff_time
+                ):
+                    skipped_recent += 1
+                    continue
+                yield entry
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Only keep a small window of submitted work so an interrupt does not
+            # have to wait for the whole queue to drain
+            entries = pending_entries()
+            in_flight = {}
+            while True:
+                if cancel is not None and cancel.is_set():
+                    for future in in_flight:
+                        future.cancel()
+                    break
 
-        for entry in database.database_entries.values():
-            # Skip entries that were checked recently
-            if cutoff_time and entry.last_checked and entry.last_checked > cutoff_time:
-                skipped_recent += 1
-                continue
-
-            metadata = download_url(entry)
-            if metadata is None:
-                continue
-
-            data = {
-                "last_checked": now,
-                "last_status": metadata.last_status,
-            }
-            database.update_entry(entry.text_id, **data)
-            written += 1
-            if written % 50 == 0:
-                database.save_database()
+                for entry in entries:
+                    future = executor.submit(
+                        download_url, entry, limiter, session, blob_store, codec
+                    )
+                    in_flight[future] = entry
+                    if len(in_flight) >= workers * 2:
+                        break
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = in_flight.pop(future)
+                    checked = future.result()
+                    if checked is None:
+                        continue
+
+                    metadata, result = checked
+                    # Recorded before the database, so no change goes unrecorded
+                    changeset.append(entry.text_id, {"result": result})
+                    results[result] += 1
+                    data = {
+                        "last_checked": now,
+                        "last_status": metadata.last_status,
+                    }
+                    database.update_entry(entry.text_id, **data)
+
+        if cancel is not None and cancel.is_set():
+            sync_journal()
+            changeset.close()
+            database.detach_journal()
+            print(f"Cancelled, {summarize(results)} recorded")
+            return
+
+        metrics.count("entries_skipped_total", skipped_recent, reason="recent")
+        metrics.count("entries_skipped_total", skipped_resumed, reason="resumed")
+        metrics.count("entries_skipped_total", skipped_not_due, reason="not_due")
 
         if skipped_recent > 0:
             print(
@@ -124,5 +434,52 @@ def download_all_urls(database: URLDatabase, min_interval_minutes: int = 0):
                 f"{min_interval_minutes} minutes"
             )
 
-        # Ensure database is saved at the end
-        database.save_database()
+        if skipped_resumed > 0:
+            print(f"Skipped {skipped_resumed} entries checked by the interrupted run")
+
+        if skipped_not_due > 0:
+            print(f"Skipped {skipped_not_due} entries that are not due yet")
+
+        changeset.close()
+        print(f"Changeset {run_id(now)}: {summarize(results)}")
+
+        if shard is None:
+            database.finish_journal()
+            database.metadata_store.sync(database)
+        else:
+            # The results are folded into the database by merge_shards
+            database.detach_journal()
+
+
+def download_shard(
+    database: URLDatabase,
+    shard: Shard,
+    lease_timeout: float = 600,
+    **kwargs,
+):
+    """Download the entries in one shard of the archive, alongside other workers.
+
+    Neither the database nor the metadata manifest are written. Database updates
+    go to the shard results and metadata to a manifest of its own, which
+    `merge_shards` folds back in once every shard is complete. The shard is leased
+    while it runs, and a worker that finds a stale lease continues where the
+    previous one stopped.
+
+    Any other arguments are passed to `download_all_urls`.
+    """
+    lease = ShardLease(shard, timeout=lease_timeout)
+    previous = lease.acquire()
+    if previous is not None:
+        print(f"Took over {shard.name} from {previous['owner']}")
+
+    set_metadata_store(database.database_path.parent, shard.metadata_store(database))
+
+    done = False
+    try:
+        download_all_urls(database, shard=shard, cancel=lease.lost, **kwargs)
+        assert not lease.lost.is_set(), (
+            f"Lost the lease on {shard.name}, another worker continues it"
+        )
+        done = True
+    finally:
+        lease.release(done=done)
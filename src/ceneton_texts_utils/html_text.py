@@ -0,0 +1,401 @@
+import re
+import textwrap
+from html.parser import HTMLParser
+
+# Whitespace that HTML collapses. Non-breaking spaces are deliberately excluded, as
+# the transcriptions use runs of &nbsp; to indent verse.
+_COLLAPSIBLE = re.compile(r"[ \t\n\r\f]+")
+_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w-]+)""", re.IGNORECASE)
+
+BLOCK_TAGS = {
+    "address",
+    "article",
+    "aside",
+    "caption",
+    "center",
+    "dd",
+    "div",
+    "dt",
+    "footer",
+    "form",
+    "header",
+    "li",
+    "nav",
+    "section",
+}
+# Block tags that are separated from their surroundings by a blank line
+PARAGRAPH_TAGS = {
+    "blockquote",
+    "dl",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "ol",
+    "p",
+    "pre",
+    "table",
+    "ul",
+}
+SKIP_TAGS = {"head", "script", "style", "title"}
+# Elements that end when the next one starts, as the older pages rarely close them
+IMPLIED_END_TAGS = {"dd": {"dd", "dt"}, "dt": {"dd", "dt"}, "li": {"li"}}
+
+# Bump when a change to the converter changes its output
+VERSION = "2"
+
+HR_CHAR = "━"
+BULLET = "•"
+
+
+def decode_html(content: bytes) -> str:
+    """Decode an HTML document using its declared charset.
+
+    Pages without a declaration are tried as UTF-8 first, as w3m does, and fall back
+    to Windows-1252, which is what most of the older Ceneton pages are written in.
+    """
+    match = _CHARSET.search(content[:4096])
+    if match:
+        try:
+            return content.decode(match.group(1).decode("ascii"), errors="replace")
+        except LookupError:
+            pass
+
+    try:
+        return content.decode("utf-8")
+    except UnicodeDecodeError:
+        return content.decode("cp1252", errors="replace")
+
+
+class _Table:
+    def __init__(self):
+        self.rows: list[list[str]] = []
+
+    def add_row(self):
+        self.rows.append([])
+
+    def add_cell(self):
+        if not self.rows:
+            self.add_row()
+        self.rows[-1].append("")
+
+    def add_text(self, text: str):
+        if not self.rows or not self.rows[-1]:
+            self.add_cell()
+        self.rows[-1][-1] += text
+
+
+class HTMLTextParser(HTMLParser):
+    """Renders HTML as plain text, laid out like `w3m -dump`.
+
+    Text is collected inline until a block boundary, where it is collapsed and
+    wrapped to `width` columns at the current indentation. Block elements are kept
+    on a stack with their alignment, and end tags that the page leaves out are
+    implied as HTML does: an open <p> ends at the next block, and any elements
+    still open end with their parent or the document.
+    """
+
+    def __init__(self, width: int = 80):
+        super().__init__(convert_charrefs=True)
+        self.width = width
+        self.lines: list[str] = []
+
+        self._inline: list[str] = []
+        self._indent = 0
+        # The open block elements and their alignment, innermost last
+        self._open: list[tuple[str, str | None]] = []
+        self._list_counters: list[int | None] = []
+        self._marker: str | None = None
+        self._skip_depth = 0
+        self._pre_depth = 0
+        self._pre_text: list[str] = []
+        self._table: _Table | None = None
+        self._table_depth = 0
+        self._blank_pending = False
+
+    # Output
+
+    def _blank_line(self):
+        if self.lines and self.lines[-1] != "":
+            self._blank_pending = True
+
+    def _emit(self, line: str):
+        if self._blank_pending:
+            self.lines.append("")
+            self._blank_pending = False
+        self.lines.append(line.rstrip())
+
+    def _aligned(self, line: str) -> str:
+        align = next((a for _, a in reversed(self._open) if a), None)
+        if align == "center":
+            return line.strip().center(self.width).rstrip()
+        if align == "right":
+            return line.strip().rjust(self.width)
+        return line
+
+    def _flush(self):
+        """Lay out the collected inline text as wrapped lines."""
+        text = "".join(self._inline)
+        self._inline = []
+
+        segments = text.split("\n")
+        if segments and not segments[-1].strip(" \t\r\f"):
+            # A trailing <br> does not add an empty line
+            segments.pop()
+
+        if not any(_COLLAPSIBLE.sub("", s) for s in segments):
+            return
+
+        indent = " " * self._indent
+        for segment in segments:
+            segment = _COLLAPSIBLE.sub(" ", segment).strip(" ")
+            if not segment:
+                self._emit("")
+                continue
+
+            initial = indent
+            if self._marker is not None:
+                initial = indent[: -len(self._marker)] + self._marker
+                self._marker = None
+
+            wrapped = textwrap.wrap(
+                segment,
+                width=self.width,
+                initial_indent=initial,
+                subsequent_indent=indent,
+                break_long_words=False,
+                break_on_hyphens=False,
+            )
+            for line in wrapped:
+                self._emit(self._aligned(line.replace("\xa0", " ")))
+
+    def _flush_pre(self):
+        text = "".join(self._pre_text)
+        self._pre_text = []
+
+        # A newline straight after <pre> is ignored
+        if text.startswith("\n"):
+            text = text[1:]
+        for line in text.rstrip("\n").split("\n"):
+            self._emit(" " * self._indent + line.replace("\xa0", " "))
+
+    def _render_table(self, table: _Table):
+        rows = [row for row in table.rows if any(c.strip() for c in row)]
+        if not rows:
+            return
+
+        cells = [
+            [
+                [_COLLAPSIBLE.sub(" ", seg).strip(" ") for seg in cell.split("\n")]
+                for cell in row
+            ]
+            for row in rows
+        ]
+        columns = max(len(row) for row in cells)
+        widths = [0] * columns
+        for row in cells:
+            for i, cell in enumerate(row):
+                widths[i] = max(widths[i], *(len(line) for line in cell))
+
+        # Shrink the widest columns until the table fits
+        available = self.width - self._indent - (columns - 1)
+        while sum(widths) > available and max(widths) > 10:
+            widths[widths.index(max(widths))] -= 1
+
+        indent = " " * self._indent
+        for row in cells:
+            wrapped = []
+            for i, cell in enumerate(row):
+                lines = []
+                for segment in cell:
+                    lines.extend(
+                        textwrap.wrap(segment, widths[i], break_long_words=False)
+                        or [""]
+                    )
+                wrapped.append(lines)
+
+            for line_no in range(max(len(lines) for lines in wrapped)):
+                parts = []
+                for i in range(columns):
+                    lines = wrapped[i] if i < len(wrapped) else []
+                    part = lines[line_no] if line_no < len(lines) else ""
+                    parts.append(part.ljust(widths[i]))
+                self._emit((indent + " ".join(parts)).replace("\xa0", " "))
+
+    def _end_block(self):
+        """End the innermost open block element."""
+        self._flush()
+        tag = self._open[-1][0]
+        if tag == "pre":
+            self._pre_depth = max(0, self._pre_depth - 1)
+            if self._pre_depth == 0:
+                self._flush_pre()
+        self._open.pop()
+
+        if tag == "blockquote":
+            self._indent = max(0, self._indent - 4)
+        elif tag in ("ul", "ol"):
+            if self._list_counters:
+                self._list_counters.pop()
+            self._indent = max(0, self._indent - 4)
+        elif tag == "dd":
+            self._indent = max(0, self._indent - 4)
+
+        if tag in PARAGRAPH_TAGS:
+            self._blank_line()
+
+    def _end_implied(self, tag: str):
+        """End the open elements that a new tag implicitly closes."""
+        if self._open and self._open[-1][0] == "p":
+            self._end_block()
+        if self._open and self._open[-1][0] in IMPLIED_END_TAGS.get(tag, ()):
+            self._end_block()
+
+    # Parser callbacks
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+
+        if tag in SKIP_TAGS:
+            self._skip_depth += 1
+            return
+
+        if tag == "table":
+            self._table_depth += 1
+            if self._table_depth == 1:
+                self._end_implied(tag)
+                self._flush()
+                self._blank_line()
+                self._table = _Table()
+            return
+
+        if self._table is not None:
+            # Nested tables are flattened into the cells of the outer table
+            if tag == "tr" and self._table_depth == 1:
+                self._table.add_row()
+            elif tag in ("td", "th") and self._table_depth == 1:
+                self._table.add_cell()
+            elif tag == "br":
+                self._table.add_text("\n")
+            elif tag in ("td", "th"):
+                self._table.add_text(" ")
+            return
+
+        if tag == "br":
+            self._inline.append("\n")
+            return
+
+        if tag == "img":
+            if attrs.get("alt"):
+                self._inline.append(attrs["alt"])
+            return
+
+        if tag == "hr":
+            self._end_implied(tag)
+            self._flush()
+            self._emit(HR_CHAR * (self.width - self._indent))
+            return
+
+        if tag in BLOCK_TAGS or tag in PARAGRAPH_TAGS:
+            self._end_implied(tag)
+            self._flush()
+            if tag in PARAGRAPH_TAGS:
+                self._blank_line()
+
+            align = "center" if tag == "center" else attrs.get("align")
+            self._open.append((tag, align))
+
+            if tag == "blockquote":
+                self._indent += 4
+            elif tag in ("ul", "ol"):
+                self._list_counters.append(0 if tag == "ol" else None)
+                self._indent += 4
+            elif tag == "li":
+                counter = self._list_counters[-1] if self._list_counters else None
+                if counter is None:
+                    self._marker = f"{BULLET} "
+                else:
+                    counter += 1
+                    self._list_counters[-1] = counter
+                    self._marker = f"{counter}. "
+            elif tag == "dd":
+                self._indent += 4
+            elif tag == "pre":
+                self._pre_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+            return
+
+        if tag == "table":
+            self._table_depth = max(0, self._table_depth - 1)
+            if self._table_depth == 0 and self._table is not None:
+                table, self._table = self._table, None
+                self._render_table(table)
+                self._blank_line()
+            return
+
+        if self._table is not None:
+            return
+
+        if tag in BLOCK_TAGS or tag in PARAGRAPH_TAGS:
+            if all(open_tag != tag for open_tag, _ in self._open):
+                # A stray end tag still ends the text before it
+                self._flush()
+                if tag in PARAGRAPH_TAGS:
+                    self._blank_line()
+                return
+
+            # Elements left open inside this one end with it
+            while self._open:
+                open_tag = self._open[-1][0]
+                self._end_block()
+                if open_tag == tag:
+                    break
+
+    def handle_data(self, data):
+        if self._skip_depth:
+            return
+
+        if self._pre_depth and self._table is None:
+            self._pre_text.append(data)
+            return
+
+        # Line breaks in the source are just whitespace, so "\n" can be used to
+        # mark <br>
+        data = _COLLAPSIBLE.sub(" ", data)
+        if self._table is not None:
+            self._table.add_text(data)
+        else:
+            self._inline.append(data)
+
+    def close(self):
+        super().close()
+        if self._table is not None:
+            self._render_table(self._table)
+            self._table = None
+        while self._open:
+            self._end_block()
+        self._flush()
+
+    def get_text(self) -> str:
+        lines = self.lines
+        while lines and not lines[0]:
+            lines = lines[1:]
+        while lines and not lines[-1]:
+            lines = lines[:-1]
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def html_to_text(content: bytes | str, width: int = 80) -> str:
+    """Convert an HTML document to plain text, approximating `w3m -dump`."""
+    if isinstance(content, bytes):
+        content = decode_html(content)
+
+    parser = HTMLTextParser(width=width)
+    parser.feed(content)
+    parser.close()
+    return parser.get_text()
@@ -1,29 +1,162 @@
 import csv
+import os
+import re
 import sqlite3
+from collections.abc import Iterable, Iterator
 from pathlib import Path
+from typing import Any
 
 from tqdm import tqdm
 
-from ceneton_texts_utils.url_database import URLDatabase, URLDatabaseEntry
+from ceneton_texts_utils import metrics
+from ceneton_texts_utils.changeset import read_changes
+from ceneton_texts_utils.url_database import (
+    SQLITE_SUFFIXES,
+    URLDatabase,
+    URLDatabaseEntry,
+    atomic_open,
+)
+
+CENSUS_COLUMNS = [
+    "nummer",
+    "auteurva",
+    "titel",
+    "jaarnr",
+    "genre",
+    "oorspr_auteur_va",
+    "drukkerva",
+    "plaats_van_uitgave",
+]
+
+OUTPUT_COLUMNS = ["nummer", "text_id", *CENSUS_COLUMNS[1:]]
+
+# The table of an SQLite output. Besides the census columns it has the slug each
+# row was resolved from, the year as a number and the state of the archived text.
+INDEX_TABLE = "texts"
+
+_SQLITE_SCHEMA = f"""
+CREATE TABLE {INDEX_TABLE} (
+    nummer INTEGER NOT NULL,
+    text_id INTEGER NOT NULL,
+    slug TEXT NOT NULL,
+    auteurva TEXT,
+    titel TEXT,
+    jaarnr TEXT,
+    year INTEGER,
+    genre TEXT,
+    oorspr_auteur_va TEXT,
+    drukkerva TEXT,
+    plaats_van_uitgave TEXT,
+    url TEXT NOT NULL,
+    sha256 TEXT,
+    content_length INTEGER,
+    last_checked TEXT,
+    has_text INTEGER NOT NULL
+);
+"""
+
+# Created after the rows are inserted, which is faster than maintaining them
+_SQLITE_INDEXES = f"""
+CREATE INDEX {INDEX_TABLE}_auteurva ON {INDEX_TABLE} (auteurva);
+CREATE INDEX {INDEX_TABLE}_year ON {INDEX_TABLE} (year);
+CREATE INDEX {INDEX_TABLE}_genre ON {INDEX_TABLE} (genre, year);
+CREATE INDEX {INDEX_TABLE}_text_id ON {INDEX_TABLE} (text_id);
+CREATE INDEX {INDEX_TABLE}_slug ON {INDEX_TABLE} (slug);
+"""
+
+_ARCHIVE_COLUMNS = ["url", "sha256", "content_length", "last_checked", "has_text"]
+_SQLITE_COLUMNS = [
+    "nummer",
+    "text_id",
+    "slug",
+    *CENSUS_COLUMNS[1:4],
+    "year",
+    *CENSUS_COLUMNS[4:],
+    *_ARCHIVE_COLUMNS,
+]
+
+_YEAR = re.compile(r"\d{4}")
+
+# Stay well below the SQLite limit on the number of query parameters
+_MAX_PARAMETERS = 500
 
 
 class SlugIndexer:
     def __init__(self, url_database: URLDatabase):
         self.url_database = url_database
-        self.urls_by_slug = {entry.source_slug: entry for entry in url_database}
+
+        # Only successfully downloaded entries can be resolved
+        self.urls_by_slug: dict[str, URLDatabaseEntry] = {}
+        self.urls_by_original_slug: dict[str, URLDatabaseEntry] = {}
+        for entry in url_database:
+            if entry.last_status != 200:
+                continue
+            self.urls_by_slug[entry.source_slug] = entry
+            if entry.original_slug:
+                # The first mapping entry for a slug wins
+                self.urls_by_original_slug.setdefault(entry.original_slug, entry)
 
     def get_by_slug(self, slug: str) -> URLDatabaseEntry | None:
         # First check if we have a successful URL for the primary entry.
-        entry = self.urls_by_slug.get(f"ceneton:{slug}", None)
-        if entry is not None and entry.last_status == 200:
+        entry = self.urls_by_slug.get(f"ceneton:{slug}")
+        if entry is not None:
             return entry
 
         # If not, see if we have a successful URL for the mapping entry.
-        for entry in self.url_database:
-            if entry.original_slug == f"ceneton:{slug}" and entry.last_status == 200:
-                return entry
+        return self.urls_by_original_slug.get(f"ceneton:{slug}")
+
+
+def _affected_slugs(
+    url_database: URLDatabase, indexed: set[int], changed_since: str
+) -> set[str]:
+    """Find the census slugs that may resolve differently than they did in an
+    existing output, going by the entries checked since the run changed_since.
+
+    Only entries that became resolvable or stopped being resolvable matter, which
+    are those whose last status was or was not 200 against whether they are in
+    the output.
+    """
+    slugs = set()
+    for text_id in read_changes(url_database, changed_since):
+        entry = url_database.get_entry(text_id)
+        if entry is None or (entry.last_status == 200) == (text_id in indexed):
+            continue
+        for slug in (entry.source_slug, entry.original_slug):
+            if slug and slug.startswith("ceneton:"):
+                slugs.add(slug.removeprefix("ceneton:"))
+    return slugs
 
-        return None
+
+def _census_rows(
+    conn: sqlite3.Connection, database_table: str, slugs: Iterable[str] | None = None
+) -> Iterator[sqlite3.Row]:
+    """The census rows with a URL in order, or only those with one of slugs."""
+    columns = ", ".join(["http", *CENSUS_COLUMNS])
+    query = f"SELECT {columns} FROM {database_table} where http is not null"
+
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    if slugs is None:
+        yield from cursor.execute(f"{query} order by nummer")
+        return
+
+    slugs = sorted(slugs)
+    for start in range(0, len(slugs), _MAX_PARAMETERS):
+        chunk = slugs[start : start + _MAX_PARAMETERS]
+        placeholders = ", ".join("?" * len(chunk))
+        yield from cursor.execute(f"{query} and http in ({placeholders})", chunk)
+
+
+def _resolve(
+    rows: Iterable[sqlite3.Row], slug_indexer: SlugIndexer
+) -> Iterator[tuple[sqlite3.Row, URLDatabaseEntry]]:
+    for row in rows:
+        entry = slug_indexer.get_by_slug(row["http"])
+        if entry:
+            metrics.count("rows_total", result="resolved")
+            yield row, entry
+        else:
+            metrics.count("rows_total", result="unresolved")
 
 
 def index_ceneton(
@@ -31,11 +164,22 @@ def index_ceneton(
     url_path: Path,
     output_path: Path,
     database_table: str | None = None,
+    changed_since: str | None = None,
 ):
+    """Resolve the census rows with a URL to archived texts and write them out.
+
+    The output is a CSV file, or an SQLite database if output_path has an SQLite
+    suffix, see `write_sqlite_index`.
+
+    With changed_since, a crawl run id, an existing output is updated instead:
+    only the rows of entries whose status changed in that run or later are
+    resolved again, and a CSV output is left alone if there are none.
+    """
     assert sqlite_path.exists(), "Ceneton database not found"
     assert url_path.exists(), "URL database not found"
 
-    slug_indexer = SlugIndexer(URLDatabase(url_path))
+    url_database = URLDatabase(url_path)
+    slug_indexer = SlugIndexer(url_database)
 
     with sqlite3.connect(sqlite_path) as conn:
         if database_table is None:
@@ -44,36 +188,179 @@ def index_ceneton(
             database_table = cursor.fetchone()[0]
             assert database_table is not None, "No tables found in database"
 
-        cursor = conn.cursor()
-        cursor.execute(
-            f"SELECT http, nummer, auteurva, titel, jaarnr, genre, oorspr_auteur_va, drukkerva, plaats_van_uitgave FROM {database_table} where http is not null order by nummer"  # noqa: E501
-        )
-
-        output_columns = [
-            "nummer",
-            "text_id",
-            "auteurva",
-            "titel",
-            "jaarnr",
-            "genre",
-            "oorspr_auteur_va",
-            "drukkerva",
-            "plaats_van_uitgave",
-        ]
-
-        cursor.row_factory = sqlite3.Row
-
-        all_rows = []
-        for row in tqdm(cursor.fetchall()):
-            slug = row["http"]
-            entry = slug_indexer.get_by_slug(slug)
-            if entry:
-                row = dict(row)
-                row["text_id"] = entry.text_id
-                row = {k: v for k, v in row.items() if k in output_columns}
-                all_rows.append(row)
-
-        with open(output_path, "w") as f:
-            writer = csv.DictWriter(f, fieldnames=output_columns)
+        if output_path.suffix in SQLITE_SUFFIXES:
+            if changed_since is not None and output_path.exists():
+                update_sqlite_index(
+                    conn, database_table, slug_indexer, output_path, changed_since
+                )
+            else:
+                write_sqlite_index(conn, database_table, slug_indexer, output_path)
+            return
+
+        affected: set[str] | None = None
+        existing: dict[str, dict[str, str]] = {}
+        if changed_since is not None and output_path.exists():
+            with open(output_path, "r") as f:
+                existing = {row["nummer"]: row for row in csv.DictReader(f)}
+            indexed = {int(row["text_id"]) for row in existing.values()}
+            affected = _affected_slugs(url_database, indexed, changed_since)
+            if not affected:
+                print(f"{output_path} is up to date")
+                return
+            print(f"Updating {output_path} for {len(affected)} changed slugs")
+
+        # Rows are streamed from the cursor straight into the output file
+        with atomic_open(output_path, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=OUTPUT_COLUMNS)
             writer.writeheader()
-            writer.writerows(all_rows)
+            for row in tqdm(_census_rows(conn, database_table)):
+                slug = row["http"]
+                if affected is not None and slug not in affected:
+                    # Unchanged since the existing output was written
+                    previous = existing.get(str(row["nummer"]))
+                    if previous is not None:
+                        writer.writerow(previous)
+                    continue
+
+                entry = slug_indexer.get_by_slug(slug)
+                if entry:
+                    metrics.count("rows_total", result="resolved")
+                    row = dict(row)
+                    row["text_id"] = entry.text_id
+                    row = {k: v for k, v in row.items() if k in OUTPUT_COLUMNS}
+                    writer.writerow(row)
+                else:
+                    metrics.count("rows_total", result="unresolved")
+
+
+def _year(jaarnr: Any) -> int | None:
+    """The first year in a census year, which may be a range or annotated."""
+    match = _YEAR.search(str(jaarnr or ""))
+    return int(match[0]) if match else None
+
+
+def _archive_values(entry: URLDatabaseEntry) -> dict[str, Any]:
+    metadata = entry.metadata
+    return {
+        "url": entry.url,
+        "sha256": metadata.sha256 if metadata else None,
+        "content_length": metadata.content_length if metadata else None,
+        "last_checked": entry.last_checked.isoformat() if entry.last_checked else None,
+        "has_text": entry.text_path.exists(),
+    }
+
+
+def _sqlite_row(row: sqlite3.Row, entry: URLDatabaseEntry) -> tuple:
+    values = {
+        **{column: row[column] for column in CENSUS_COLUMNS},
+        "text_id": entry.text_id,
+        "slug": row["http"],
+        "year": _year(row["jaarnr"]),
+        **_archive_values(entry),
+    }
+    return tuple(values[column] for column in _SQLITE_COLUMNS)
+
+
+def _insert_rows(
+    output: sqlite3.Connection,
+    rows: Iterable[sqlite3.Row],
+    slug_indexer: SlugIndexer,
+) -> int:
+    placeholders = ", ".join("?" * len(_SQLITE_COLUMNS))
+    cursor = output.executemany(
+        f"INSERT INTO {INDEX_TABLE} ({', '.join(_SQLITE_COLUMNS)}) "
+        f"VALUES ({placeholders})",
+        (_sqlite_row(row, entry) for row, entry in _resolve(rows, slug_indexer)),
+    )
+    return cursor.rowcount
+
+
+def write_sqlite_index(
+    conn: sqlite3.Connection,
+    database_table: str,
+    slug_indexer: SlugIndexer,
+    output_path: Path,
+):
+    """Write the resolved census rows to a new SQLite database in output_path.
+
+    The texts table has typed census columns, the year as a number and the URL,
+    sha256, content length, last check and text availability of the archived
+    text. It is indexed on author, year, genre and text_id. The rows are inserted
+    in a single transaction into a temporary file that replaces output_path once
+    it is complete.
+    """
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    tmp_path.unlink(missing_ok=True)
+
+    output = sqlite3.connect(tmp_path)
+    try:
+        output.executescript(_SQLITE_SCHEMA)
+        with output:
+            inserted = _insert_rows(
+                output, tqdm(_census_rows(conn, database_table)), slug_indexer
+            )
+        output.executescript(_SQLITE_INDEXES + "ANALYZE;")
+    finally:
+        output.close()
+
+    os.replace(tmp_path, output_path)
+    print(f"Wrote {inserted} rows to {output_path}")
+
+
+def update_sqlite_index(
+    conn: sqlite3.Connection,
+    database_table: str,
+    slug_indexer: SlugIndexer,
+    output_path: Path,
+    changed_since: str,
+):
+    """Update an SQLite output for the entries checked since the run changed_since.
+
+    The archive columns of every entry checked are updated, and the rows of
+    entries that became resolvable or stopped being resolvable are resolved
+    again, all in a single transaction.
+    """
+    url_database = slug_indexer.url_database
+    checked = read_changes(url_database, changed_since)
+
+    output = sqlite3.connect(output_path)
+    try:
+        cursor = output.execute(f"SELECT DISTINCT text_id FROM {INDEX_TABLE}")
+        indexed = {text_id for (text_id,) in cursor}
+        affected = sorted(_affected_slugs(url_database, indexed, changed_since))
+
+        with output:
+            for start in range(0, len(affected), _MAX_PARAMETERS):
+                chunk = affected[start : start + _MAX_PARAMETERS]
+                placeholders = ", ".join("?" * len(chunk))
+                output.execute(
+                    f"DELETE FROM {INDEX_TABLE} WHERE slug IN ({placeholders})", chunk
+                )
+            inserted = _insert_rows(
+                output, _census_rows(conn, database_table, affected), slug_indexer
+            )
+
+            assignments = ", ".join(f"{column} = ?" for column in _ARCHIVE_COLUMNS)
+            updates = []
+            for text_id in checked:
+                entry = url_database.get_entry(text_id)
+                # Rows of entries that are no longer resolvable were deleted
+                if (
+                    entry is not None
+                    and entry.last_status == 200
+                    and text_id in indexed
+                ):
+                    values = _archive_values(entry)
+                    updates.append(
+                        (*(values[c] for c in _ARCHIVE_COLUMNS), entry.text_id)
+                    )
+            output.executemany(
+                f"UPDATE {INDEX_TABLE} SET {assignments} WHERE text_id = ?", updates
+            )
+    finally:
+        output.close()
+
+    print(
+        f"Updated {output_path}: {len(affected)} slugs resolved again, {inserted} "
+        f"rows inserted, {len(updates)} entries updated"
+    )
@@ -0,0 +1,193 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROMETHEUS_PREFIX = "ceneton"
+
+
+def _key(name: str, labels: dict[str, str]) -> str:
+    if not labels:
+        return name
+    pairs = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{pairs}}}"
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """Bucket counts as Prometheus reports them: everything <= each bound."""
+        total = 0
+        buckets = []
+        for bound, count in zip([*map(str, BUCKETS), "+Inf"], self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+class RunMetrics:
+    """Counters and latency histograms collected over a single command run.
+
+    Names follow Prometheus conventions: counters of events end in _total, and
+    histograms of durations end in _seconds. Updates may come from any thread.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started = datetime.now(tz=timezone.utc)
+        self.finished: datetime | None = None
+
+        self._start = time.perf_counter()
+        self._duration: float | None = None
+        self._lock = threading.Lock()
+        self.counters: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+
+    def count(self, name: str, value: float = 1, **labels: str):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def finish(self):
+        self.finished = datetime.now(tz=timezone.utc)
+        self._duration = time.perf_counter() - self._start
+
+    @property
+    def duration(self) -> float:
+        if self._duration is None:
+            return time.perf_counter() - self._start
+        return self._duration
+
+    def to_json(self) -> str:
+        report = {
+            "command": self.command,
+            "started": self.started.isoformat(),
+            "finished": self.finished.isoformat() if self.finished else None,
+            "duration_seconds": round(self.duration, 6),
+            "counters": dict(sorted(self.counters.items())),
+            "histograms": {
+                key: {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "buckets": dict(histogram.cumulative()),
+                }
+                for key, histogram in sorted(self.histograms.items())
+            },
+        }
+        return json.dumps(report, indent=2) + "\n"
+
+    def to_prometheus(self) -> str:
+        """Render the metrics for the node_exporter textfile collector."""
+        command = {"command": self.command}
+        lines = [
+            f"# TYPE {PROMETHEUS_PREFIX}_run_duration_seconds gauge",
+            f"{_key(f'{PROMETHEUS_PREFIX}_run_duration_seconds', command)} "
+            f"{self.duration:.6f}",
+            f"# TYPE {PROMETHEUS_PREFIX}_run_timestamp_seconds gauge",
+            f"{_key(f'{PROMETHEUS_PREFIX}_run_timestamp_seconds', command)} "
+            f"{self.started.timestamp():.0f}",
+        ]
+
+        typed = set()
+        for key, value in sorted(self.counters.items()):
+            name, _, labels = key.partition("{")
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{{{_labels(command, labels)}}} {value:g}")
+
+        for key, histogram in sorted(self.histograms.items()):
+            name, _, labels = key.partition("{")
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            labels = _labels(command, labels)
+            for bound, count in histogram.cumulative():
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(command: dict[str, str], labels: str) -> str:
+    """Join the command label with the labels part of a metric key."""
+    base = _key("", command)[1:-1]
+    return f"{base},{labels[:-1]}" if labels else base
+
+
+# The metrics of the current run. Instrumented code is a no-op when this is None.
+# Worker processes started with fork inherit it, so process pools reset it with
+# init_worker; whatever a worker recorded would be lost with its copy otherwise.
+_active: RunMetrics | None = None
+
+
+def init_worker():
+    """Initializer for process pools, so workers do not record into a copied run."""
+    global _active
+    _active = None
+
+
+@contextmanager
+def collect(command: str):
+    """Collect metrics from instrumented code for the duration of the block."""
+    global _active
+    assert _active is None, "Metrics are already being collected"
+    _active = RunMetrics(command)
+    try:
+        yield _active
+    finally:
+        _active.finish()
+        _active = None
+
+
+def count(name: str, value: float = 1, **labels: str):
+    if _active is not None:
+        _active.count(name, value, **labels)
+
+
+def observe(name: str, seconds: float, **labels: str):
+    if _active is not None:
+        _active.observe(name, seconds, **labels)
+
+
+@contextmanager
+def timed(name: str, **labels: str):
+    """Record how long the block takes in the histogram name."""
+    if _active is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _active.observe(name, time.perf_counter() - start, **labels)
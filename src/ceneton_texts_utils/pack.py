@@ -0,0 +1,272 @@
+import csv
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+from dataclasses import asdict
+from pathlib import Path
+
+from tqdm import tqdm
+
+from ceneton_texts_utils.compression import Codec, get_codec
+from ceneton_texts_utils.url_database import (
+    DATABASE_FIELDS,
+    URLDatabase,
+    URLDatabaseEntry,
+    URLDatabaseEntryMetadata,
+    atomic_open,
+)
+
+PACK_NAME = "archive.ctpack"
+
+# A pack file starts with a fixed-size header pointing at the entry table. The
+# table has one fixed-size row per text_id from first_id, so the row of any entry
+# is found by its position alone. Each row holds the offset, length and
+# fingerprint of the entry's content, text and metadata members. Members without
+# data have a length of 0.
+#
+# Repacking appends the members that changed and a new table, and only then
+# rewrites the header, so an interrupted repack leaves the previous state intact.
+_MAGIC = b"CTPACK01"
+_HEADER = struct.Struct("<8s8sQIIQI8s")
+MEMBERS = ("content", "text", "metadata")
+_ROW = struct.Struct("<" + "QI8s" * len(MEMBERS))
+
+_EMPTY = (0, 0, b"\0" * 8)
+
+
+def _fingerprint(key: str) -> bytes:
+    return hashlib.sha256(key.encode("utf-8")).digest()[:8]
+
+
+def _compress(data: bytes, codec: Codec | None) -> bytes:
+    if codec is None:
+        return data
+    buffer = io.BytesIO()
+    with codec.writer(buffer) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def _decompress(data: bytes, codec: Codec | None) -> bytes:
+    if codec is None:
+        return data
+    with codec.open(io.BytesIO(data)) as f:
+        return f.read()
+
+
+def _metadata_bytes(entry: URLDatabaseEntry) -> bytes | None:
+    metadata = entry.metadata
+    if metadata is None:
+        return None
+    return json.dumps(asdict(metadata), default=str, sort_keys=True).encode("utf-8")
+
+
+def _content_version(entry: URLDatabaseEntry) -> str | None:
+    content_path = entry.content_path
+    if not content_path.exists():
+        return None
+    metadata = entry.metadata
+    if metadata is not None and metadata.sha256:
+        return metadata.sha256
+    stat = content_path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _database_bytes(database: URLDatabase) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=DATABASE_FIELDS)
+    writer.writeheader()
+    for entry in sorted(database, key=lambda e: e.text_id):
+        writer.writerow({f: getattr(entry, f) for f in DATABASE_FIELDS})
+    return buffer.getvalue().encode("utf-8")
+
+
+class PackedArchive:
+    """Read-only, memory-mapped access to a pack file written by `pack_archive`."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            codec_name,
+            self._table_offset,
+            self.first_id,
+            self.count,
+            self._database_offset,
+            self._database_length,
+            self._database_fingerprint,
+        ) = _HEADER.unpack_from(self._mmap, 0)
+        assert magic == _MAGIC, f"{path} is not a packed archive"
+        self.codec = get_codec(codec_name.rstrip(b"\0").decode("ascii") or None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+
+    def _row(self, text_id: int) -> list[tuple[int, int, bytes]]:
+        index = text_id - self.first_id
+        if not 0 <= index < self.count:
+            return [_EMPTY] * len(MEMBERS)
+        values = _ROW.unpack_from(self._mmap, self._table_offset + index * _ROW.size)
+        return [tuple(values[i : i + 3]) for i in range(0, len(values), 3)]
+
+    def _member(self, text_id: int, member: str) -> bytes | None:
+        offset, length, _ = self._row(text_id)[MEMBERS.index(member)]
+        if length == 0:
+            return None
+        return _decompress(self._mmap[offset : offset + length], self.codec)
+
+    def content(self, text_id: int) -> bytes | None:
+        return self._member(text_id, "content")
+
+    def text(self, text_id: int) -> str | None:
+        text = self._member(text_id, "text")
+        return None if text is None else text.decode("utf-8")
+
+    def metadata(self, text_id: int) -> URLDatabaseEntryMetadata | None:
+        data = self._member(text_id, "metadata")
+        if data is None:
+            return None
+        return URLDatabaseEntryMetadata(**json.loads(data))
+
+    def database(self) -> bytes:
+        """The database as it was when packed, in the CSV format."""
+        offset, length = self._database_offset, self._database_length
+        return _decompress(self._mmap[offset : offset + length], self.codec)
+
+    def text_ids(self) -> list[int]:
+        """The text_ids of all packed entries that have any data."""
+        return [
+            text_id
+            for text_id in range(self.first_id, self.first_id + self.count)
+            if any(length for _, length, _ in self._row(text_id))
+        ]
+
+
+def _read_existing(pack_path: Path) -> tuple[dict[int, list], bytes, Codec | None]:
+    with PackedArchive(pack_path) as pack:
+        rows = {
+            text_id: pack._row(text_id)
+            for text_id in range(pack.first_id, pack.first_id + pack.count)
+        }
+        return rows, pack._database_fingerprint, pack.codec
+
+
+def pack_archive(
+    database: URLDatabase,
+    pack_path: str | Path,
+    codec: Codec | None = None,
+    full: bool = False,
+) -> tuple[int, int]:
+    """Write the content, text and metadata of every entry to a single pack file.
+
+    If the pack already exists, only the members that changed since it was written
+    are appended to it. With full, or when the codec differs from the one the pack
+    was written with, the pack is rewritten from scratch, which also drops the
+    space taken by replaced members.
+
+    Returns the number of members written and the number of bytes they take.
+    """
+    pack_path = Path(pack_path)
+    if pack_path.exists() and not full:
+        rows, database_fingerprint, existing_codec = _read_existing(pack_path)
+        if existing_codec == codec:
+            with open(pack_path, "r+b") as f:
+                return _write_pack(f, database, rows, database_fingerprint, codec)
+        print(f"Rewriting {pack_path} as it was packed with another codec")
+
+    with atomic_open(pack_path, "wb") as f:
+        f.write(b"\0" * _HEADER.size)
+        return _write_pack(f, database, {}, None, codec)
+
+
+def _write_pack(f, database, rows, database_fingerprint, codec) -> tuple[int, int]:
+    f.seek(0, os.SEEK_END)
+    written = 0
+    written_bytes = 0
+
+    def append(data: bytes, fingerprint: bytes) -> tuple[int, int, bytes]:
+        nonlocal written, written_bytes
+        data = _compress(data, codec)
+        offset = f.tell()
+        f.write(data)
+        written += 1
+        written_bytes += len(data)
+        return offset, len(data), fingerprint
+
+    entries = sorted(database, key=lambda e: e.text_id)
+    new_rows = {}
+    for entry in tqdm(entries):
+        old_row = rows.get(entry.text_id, [_EMPTY] * len(MEMBERS))
+        row = []
+
+        metadata_bytes = _metadata_bytes(entry)
+        versions = {
+            "content": _content_version(entry),
+            "text": entry.text_version,
+            "metadata": metadata_bytes and hashlib.sha256(metadata_bytes).hexdigest(),
+        }
+        for member, old in zip(MEMBERS, old_row):
+            version = versions[member]
+            if version is None:
+                row.append(_EMPTY)
+                continue
+
+            fingerprint = _fingerprint(version)
+            if old[1] and old[2] == fingerprint:
+                row.append(old)
+            elif member == "content":
+                row.append(append(entry.content, fingerprint))
+            elif member == "text":
+                row.append(append(entry.text.encode("utf-8"), fingerprint))
+            else:
+                row.append(append(metadata_bytes, fingerprint))
+        new_rows[entry.text_id] = row
+
+    data = _database_bytes(database)
+    fingerprint = hashlib.sha256(data).digest()[:8]
+    if fingerprint == database_fingerprint:
+        f.seek(0)
+        header = _HEADER.unpack(f.read(_HEADER.size))
+        database_offset, database_length = header[5], header[6]
+        f.seek(0, os.SEEK_END)
+    else:
+        database_offset, database_length, _ = append(data, fingerprint)
+
+    first_id = min(new_rows, default=1)
+    count = max(new_rows, default=0) - first_id + 1
+    table_offset = f.tell()
+    for text_id in range(first_id, first_id + count):
+        row = new_rows.get(text_id, [_EMPTY] * len(MEMBERS))
+        f.write(_ROW.pack(*(value for member in row for value in member)))
+
+    # The new table must be on disk before the header points at it
+    f.flush()
+    os.fsync(f.fileno())
+    f.seek(0)
+    f.write(
+        _HEADER.pack(
+            _MAGIC,
+            (codec.name if codec else "").encode("ascii"),
+            table_offset,
+            first_id,
+            max(count, 0),
+            database_offset,
+            database_length,
+            fingerprint,
+        )
+    )
+    f.flush()
+    os.fsync(f.fileno())
+    return written, written_bytes
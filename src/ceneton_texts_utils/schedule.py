@@ -0,0 +1,93 @@
+import heapq
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+from ceneton_texts_utils.url_database import (
+    URLDatabaseEntry,
+    URLDatabaseEntryMetadata,
+)
+
+
+def _last_modified(metadata: URLDatabaseEntryMetadata) -> datetime | None:
+    if not metadata.last_modified:
+        return None
+    try:
+        last_modified = parsedate_to_datetime(metadata.last_modified)
+    except (TypeError, ValueError):
+        return None
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return last_modified
+
+
+@dataclass
+class RecrawlPolicy:
+    """Decides when each entry is next due to be checked, based on its history.
+
+    The longer a page has gone without changing, the longer we wait before checking
+    it again: the interval is `backoff` times the time since it last changed, so an
+    unchanged page is checked at exponentially growing intervals. Pages that have
+    changed several times are checked at least twice as often as they have changed
+    on average. Failed checks are retried after `retry_interval`, doubling with
+    every further failure. Every interval is kept between `min_interval` and
+    `max_interval`.
+    """
+
+    min_interval: timedelta = timedelta(hours=12)
+    max_interval: timedelta = timedelta(days=60)
+    retry_interval: timedelta = timedelta(hours=12)
+    backoff: float = 0.5
+
+    def _clamp(self, interval: timedelta) -> timedelta:
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def interval(
+        self, entry: URLDatabaseEntry, metadata: URLDatabaseEntryMetadata | None
+    ) -> timedelta:
+        if entry.last_status != 200 or metadata is None or metadata.sha256 is None:
+            failures = metadata.failures if metadata else 0
+            return self._clamp(self.retry_interval * 2 ** max(0, failures - 1))
+
+        last_changed = metadata.last_changed or _last_modified(metadata)
+        if last_changed is None:
+            return self.min_interval
+
+        interval = (entry.last_checked - last_changed) * self.backoff
+        if metadata.changes > 1 and metadata.first_downloaded:
+            mean = (last_changed - metadata.first_downloaded) / metadata.changes
+            interval = min(interval, mean / 2)
+        return self._clamp(interval)
+
+    def next_due(self, entry: URLDatabaseEntry) -> datetime | None:
+        """When the entry should next be checked, or None if it never has been."""
+        if not entry.last_checked:
+            return None
+        return entry.last_checked + self.interval(entry, entry.metadata)
+
+
+def due_entries(
+    entries: Iterable[URLDatabaseEntry], policy: RecrawlPolicy, now: datetime
+) -> tuple[Iterator[URLDatabaseEntry], int]:
+    """The entries that are due at now, most overdue first.
+
+    Entries that were never checked come before all others. Returns the entries
+    and the number of entries that are not due yet.
+    """
+    queue = []
+    not_due = 0
+    for entry in entries:
+        due = policy.next_due(entry)
+        if due is not None and due > now:
+            not_due += 1
+            continue
+        # text_id breaks ties, as entries cannot be compared
+        queue.append((due is not None, due or now, entry.text_id, entry))
+    heapq.heapify(queue)
+
+    def pop():
+        while queue:
+            yield heapq.heappop(queue)[-1]
+
+    return pop(), not_due
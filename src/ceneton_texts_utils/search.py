@@ -0,0 +1,451 @@
+import csv
+import json
+import mmap
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unicodedata
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from tqdm import tqdm
+
+from ceneton_texts_utils import metrics
+from ceneton_texts_utils.indexer import INDEX_TABLE
+from ceneton_texts_utils.url_database import (
+    SQLITE_SUFFIXES,
+    URLDatabase,
+    URLDatabaseEntry,
+    atomic_open,
+)
+
+SEARCH_INDEX_NAME = "search-index"
+MANIFEST_NAME = "index.json"
+
+_TOKEN = re.compile(r"\w+")
+_QUERY = re.compile(r'"([^"]*)"|(\S+)')
+
+# A segment file is a header, a fixed-size table with one row per term (sorted by
+# the UTF-8 bytes of the term), the term strings and finally the postings. The
+# fixed-size rows allow binary searching the memory-mapped file directly.
+_MAGIC = b"CTSRCH01"
+_HEADER = struct.Struct("<8sI")
+_TERM_ROW = struct.Struct("<QIQI")
+
+Postings = dict[int, list[int]]
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN.findall(unicodedata.normalize("NFKC", text).lower())
+
+
+def _encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varints(data: bytes) -> list[int]:
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+
+def encode_postings(postings: Postings) -> bytes:
+    """Encode postings as delta-encoded varints: doc count, then per document the
+    text_id delta, the number of positions and the position deltas."""
+    out = bytearray()
+    _encode_varint(len(postings), out)
+    previous_doc = 0
+    for doc in sorted(postings):
+        positions = postings[doc]
+        _encode_varint(doc - previous_doc, out)
+        _encode_varint(len(positions), out)
+        previous_position = 0
+        for position in positions:
+            _encode_varint(position - previous_position, out)
+            previous_position = position
+        previous_doc = doc
+    return bytes(out)
+
+
+def decode_postings(data: bytes) -> Postings:
+    values = _decode_varints(data)
+    postings = {}
+    i = 1
+    doc = 0
+    for _ in range(values[0]):
+        doc += values[i]
+        count = values[i + 1]
+        i += 2
+        positions = []
+        position = 0
+        for delta in values[i : i + count]:
+            position += delta
+            positions.append(position)
+        postings[doc] = positions
+        i += count
+    return postings
+
+
+def write_segment(path: Path, terms: Iterable[tuple[str, bytes]]):
+    """Write a segment from (term, encoded postings) pairs sorted by term bytes."""
+    rows = []
+    strings = bytearray()
+    with tempfile.TemporaryFile(dir=path.parent) as postings_file:
+        postings_offset = 0
+        for term, postings in terms:
+            term_bytes = term.encode("utf-8")
+            rows.append((len(strings), len(term_bytes), postings_offset, len(postings)))
+            strings += term_bytes
+            postings_file.write(postings)
+            postings_offset += len(postings)
+
+        strings_start = _HEADER.size + _TERM_ROW.size * len(rows)
+        postings_start = strings_start + len(strings)
+
+        postings_file.seek(0)
+        with atomic_open(path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(rows)))
+            for string_offset, string_length, offset, length in rows:
+                f.write(
+                    _TERM_ROW.pack(
+                        strings_start + string_offset,
+                        string_length,
+                        postings_start + offset,
+                        length,
+                    )
+                )
+            f.write(strings)
+            shutil.copyfileobj(postings_file, f)
+
+
+class Segment:
+    """A read-only, memory-mapped segment of the search index."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.name = path.stem
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.term_count = _HEADER.unpack_from(self._mmap, 0)
+        assert magic == _MAGIC, f"{path} is not a search index segment"
+
+    def _row(self, i: int) -> tuple[bytes, int, int]:
+        string_offset, string_length, offset, length = _TERM_ROW.unpack_from(
+            self._mmap, _HEADER.size + i * _TERM_ROW.size
+        )
+        term = self._mmap[string_offset : string_offset + string_length]
+        return term, offset, length
+
+    def _lower_bound(self, key: bytes) -> int:
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._row(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def raw_postings(self, term: str) -> bytes | None:
+        key = term.encode("utf-8")
+        i = self._lower_bound(key)
+        if i < self.term_count:
+            found, offset, length = self._row(i)
+            if found == key:
+                return self._mmap[offset : offset + length]
+        return None
+
+    def prefix(self, prefix: str) -> Iterator[tuple[str, bytes]]:
+        key = prefix.encode("utf-8")
+        for i in range(self._lower_bound(key), self.term_count):
+            term, offset, length = self._row(i)
+            if not term.startswith(key):
+                break
+            yield term.decode("utf-8"), self._mmap[offset : offset + length]
+
+    def terms(self) -> Iterator[tuple[str, bytes]]:
+        return self.prefix("")
+
+    def close(self):
+        self._mmap.close()
+
+
+def _tokenize_entry(entry: URLDatabaseEntry) -> tuple[int, dict[str, list[int]]]:
+    positions = defaultdict(list)
+    for position, token in enumerate(tokenize(entry.text)):
+        positions[token].append(position)
+    return entry.text_id, positions
+
+
+class SearchIndex:
+    """Inverted index over the converted texts, stored as immutable segments.
+
+    Updating the index writes the changed texts to new segments. The manifest maps
+    every text_id to the segment holding its current version, and postings in other
+    segments are ignored. Segments are merged once there are too many of them.
+    """
+
+    def __init__(self, index_folder: str | Path, max_segments: int = 8):
+        self.index_folder = Path(index_folder)
+        self.max_segments = max_segments
+
+        manifest_path = self.index_folder / MANIFEST_NAME
+        if manifest_path.exists():
+            self.manifest = json.loads(manifest_path.read_text())
+        else:
+            self.manifest = {"next_segment": 1, "segments": [], "docs": {}}
+
+        self._segments: dict[str, Segment] = {}
+
+    @classmethod
+    def for_database(cls, database: URLDatabase, **kwargs) -> "SearchIndex":
+        return cls(database.database_path.parent / SEARCH_INDEX_NAME, **kwargs)
+
+    @property
+    def docs(self) -> dict[str, dict[str, str]]:
+        return self.manifest["docs"]
+
+    def segment(self, name: str) -> Segment:
+        if name not in self._segments:
+            self._segments[name] = Segment(self.index_folder / f"{name}.seg")
+        return self._segments[name]
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+
+    def _save_manifest(self):
+        with atomic_open(self.index_folder / MANIFEST_NAME, "w") as f:
+            json.dump(self.manifest, f)
+
+    def _new_segment_name(self) -> str:
+        name = f"segment-{self.manifest['next_segment']:06d}"
+        self.manifest["next_segment"] += 1
+        return name
+
+    def _live(self, segment: str, postings: Postings) -> Postings:
+        docs = self.docs
+        return {
+            doc: positions
+            for doc, positions in postings.items()
+            if docs.get(str(doc), {}).get("segment") == segment
+        }
+
+    # Building
+
+    def update(
+        self, database: URLDatabase, jobs: int = 1, batch_size: int = 500
+    ) -> tuple[int, int]:
+        """Index new and changed texts and drop removed ones.
+
+        Returns the number of texts indexed and removed.
+        """
+        self.index_folder.mkdir(parents=True, exist_ok=True)
+
+        current = {}
+        changed = []
+        for entry in database:
+            key = entry.text_version
+            if key is None:
+                continue
+            current[str(entry.text_id)] = key
+            if self.docs.get(str(entry.text_id), {}).get("key") != key:
+                changed.append(entry)
+
+        removed = [text_id for text_id in self.docs if text_id not in current]
+        for text_id in removed:
+            del self.docs[text_id]
+
+        with (
+            ProcessPoolExecutor(
+                max_workers=jobs, initializer=metrics.init_worker
+            ) as executor,
+            tqdm(total=len(changed)) as progress,
+        ):
+            for start in range(0, len(changed), batch_size):
+                batch = changed[start : start + batch_size]
+                terms: dict[str, Postings] = defaultdict(dict)
+                for text_id, positions in executor.map(
+                    _tokenize_entry, batch, chunksize=8
+                ):
+                    for term, term_positions in positions.items():
+                        terms[term][text_id] = term_positions
+                    progress.update()
+
+                name = self._new_segment_name()
+                write_segment(
+                    self.index_folder / f"{name}.seg",
+                    (
+                        (term, encode_postings(terms[term]))
+                        for term in sorted(terms, key=lambda t: t.encode("utf-8"))
+                    ),
+                )
+                self.manifest["segments"].append(name)
+                for entry in batch:
+                    self.docs[str(entry.text_id)] = {
+                        "key": current[str(entry.text_id)],
+                        "segment": name,
+                    }
+
+        self._drop_dead_segments()
+        if len(self.manifest["segments"]) > self.max_segments:
+            self.merge()
+        else:
+            self._save_manifest()
+
+        return len(changed), len(removed)
+
+    def _drop_dead_segments(self):
+        live = {doc["segment"] for doc in self.docs.values()}
+        for name in list(self.manifest["segments"]):
+            if name not in live:
+                self.manifest["segments"].remove(name)
+                segment = self._segments.pop(name, None)
+                if segment is not None:
+                    segment.close()
+                (self.index_folder / f"{name}.seg").unlink(missing_ok=True)
+
+    def merge(self):
+        """Merge all segments into one, leaving out postings that are no longer live."""
+        old_names = list(self.manifest["segments"])
+        segments = [self.segment(name) for name in old_names]
+
+        def merged_terms() -> Iterator[tuple[str, bytes]]:
+            iterators = [iter(segment.terms()) for segment in segments]
+            heads = {i: next(it, None) for i, it in enumerate(iterators)}
+            while any(head is not None for head in heads.values()):
+                term = min(
+                    (head[0] for head in heads.values() if head is not None),
+                    key=lambda t: t.encode("utf-8"),
+                )
+                postings: Postings = {}
+                for i, head in heads.items():
+                    if head is not None and head[0] == term:
+                        postings.update(
+                            self._live(old_names[i], decode_postings(head[1]))
+                        )
+                        heads[i] = next(iterators[i], None)
+                if postings:
+                    yield term, encode_postings(postings)
+
+        name = self._new_segment_name()
+        write_segment(self.index_folder / f"{name}.seg", merged_terms())
+
+        for doc in self.docs.values():
+            doc["segment"] = name
+        self.manifest["segments"] = [name]
+        self._save_manifest()
+
+        self.close()
+        for old_name in old_names:
+            (self.index_folder / f"{old_name}.seg").unlink(missing_ok=True)
+
+    # Querying
+
+    def _term_postings(self, term: str) -> Postings:
+        postings: Postings = {}
+        for name in self.manifest["segments"]:
+            data = self.segment(name).raw_postings(term)
+            if data is not None:
+                postings.update(self._live(name, decode_postings(data)))
+        return postings
+
+    def _prefix_hits(self, prefix: str) -> dict[int, int]:
+        hits: dict[int, int] = defaultdict(int)
+        for name in self.manifest["segments"]:
+            for _, data in self.segment(name).prefix(prefix):
+                for doc, positions in self._live(name, decode_postings(data)).items():
+                    hits[doc] += len(positions)
+        return hits
+
+    def _phrase_hits(self, terms: list[str]) -> dict[int, int]:
+        if len(terms) == 1:
+            return {doc: len(p) for doc, p in self._term_postings(terms[0]).items()}
+
+        postings = [self._term_postings(term) for term in terms]
+        docs = set.intersection(*(set(p) for p in postings))
+        hits = {}
+        for doc in docs:
+            following = list(enumerate((set(p[doc]) for p in postings[1:]), 1))
+            count = sum(
+                1
+                for start in postings[0][doc]
+                if all(start + i in positions for i, positions in following)
+            )
+            if count:
+                hits[doc] = count
+        return hits
+
+    def search(self, query: str) -> dict[int, int]:
+        """Find texts matching every part of a query.
+
+        A query consists of words, "quoted phrases" and prefixes ending in `*`.
+        Returns the number of hits per text_id.
+        """
+        results: dict[int, int] | None = None
+        for phrase, word in _QUERY.findall(query):
+            if word.endswith("*"):
+                tokens = tokenize(word[:-1])
+                if not tokens:
+                    continue
+                hits = self._prefix_hits(tokens[0])
+            else:
+                tokens = tokenize(phrase or word)
+                if not tokens:
+                    continue
+                hits = self._phrase_hits(tokens)
+
+            if results is None:
+                results = dict(hits)
+            else:
+                results = {
+                    doc: count + hits[doc]
+                    for doc, count in results.items()
+                    if doc in hits
+                }
+
+        return results or {}
+
+
+def load_text_metadata(index_path: str | Path) -> dict[int, dict[str, Any]]:
+    """Load the output of index_ceneton, a CSV file or an SQLite database, keyed
+    by text_id."""
+    index_path = Path(index_path)
+    if index_path.suffix in SQLITE_SUFFIXES:
+        # Opened read-only, so a missing file is not created as an empty database
+        conn = sqlite3.connect(f"{index_path.absolute().as_uri()}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = [
+                dict(row)
+                for row in conn.execute(f"SELECT * FROM {INDEX_TABLE} ORDER BY nummer")
+            ]
+        finally:
+            conn.close()
+    else:
+        with open(index_path, "r") as f:
+            rows = list(csv.DictReader(f))
+
+    metadata = {}
+    for row in rows:
+        metadata.setdefault(int(row["text_id"]), row)
+    return metadata
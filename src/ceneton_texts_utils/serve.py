@@ -0,0 +1,342 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+from ceneton_texts_utils.compression import open_stored
+from ceneton_texts_utils.search import load_text_metadata
+from ceneton_texts_utils.url_database import (
+    DATABASE_FIELDS,
+    METADATA_MANIFEST_NAME,
+    MetadataStore,
+    URLDatabase,
+    URLDatabaseEntry,
+    set_metadata_store,
+)
+
+_ENTRY_PATH = re.compile(r"^/entries/(\d+)(?:/(content|text|metadata))?/?$")
+
+CONTENT_TYPES = {
+    "content": "text/html",
+    "text": "text/plain; charset=utf-8",
+    "json": "application/json",
+}
+
+# Identifies a version of a file: a file replaced by rename gets a new inode
+Signature = tuple[int, int, int] | None
+
+
+def _signature(path: Path) -> Signature:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _etag(data: bytes) -> str:
+    return f'"{hashlib.sha256(data).hexdigest()[:32]}"'
+
+
+@dataclass
+class CachedFile:
+    path: Path
+    signature: Signature
+    data: bytes
+    etag: str
+
+
+class FileCache:
+    """An LRU cache of file contents, bounded by their total size in bytes.
+
+    Every lookup stats the file, and a cached copy is only used while the file's
+    inode, size and modification time are unchanged. Files that are replaced on
+    disk are therefore read again on the next lookup. Files larger than the whole
+    cache are read but not cached.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[tuple[int, str], CachedFile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[int, str], path: Path) -> CachedFile | None:
+        """The contents of path, or None if it does not exist."""
+        # Stat before reading, so a file changed in between is read again next time
+        signature = _signature(path)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and (item.path, item.signature) == (path, signature):
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item
+            self.misses += 1
+            if item is not None:
+                self._remove(key)
+
+        if signature is None:
+            return None
+        try:
+            with open_stored(path) as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        item = CachedFile(path, signature, data, _etag(data))
+        if len(data) <= self.max_bytes:
+            with self._lock:
+                if key in self._items:
+                    self._remove(key)
+                self._items[key] = item
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self._items)))
+        return item
+
+    def _remove(self, key: tuple[int, str]):
+        self.size -= len(self._items.pop(key).data)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "items": len(self._items),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class ArchiveService:
+    """Answers queries about the entries of an archive from memory.
+
+    The database, the metadata manifest and the optional output of the index
+    command are loaded once, and loaded again when their files change. The files
+    are checked at most every check_interval seconds. Content and text are read
+    through a FileCache of cache_bytes. Nothing in the archive is ever written.
+    """
+
+    def __init__(
+        self,
+        database_path: Path,
+        cache_bytes: int = 256 * 1024 * 1024,
+        text_metadata_path: Path | None = None,
+        check_interval: float = 1.0,
+    ):
+        self.database = URLDatabase(database_path, read_only=True)
+        self.archive_path = self.database.database_path.parent
+        self.text_metadata_path = text_metadata_path
+        self.cache = FileCache(cache_bytes)
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._checked = 0.0
+        self._signatures: dict[str, tuple[Signature, ...]] = {}
+        self._slugs: dict[str, int] = {}
+        self._text_metadata: dict[int, dict[str, Any]] = {}
+        self.reload_if_changed()
+
+    def _sources(self) -> dict[str, tuple[Path, ...]]:
+        database_path = self.database.database_path
+        sources = {
+            # Changes to an SQLite database in WAL mode first go to the -wal file
+            "database": (
+                database_path,
+                database_path.with_name(f"{database_path.name}-wal"),
+            ),
+            "metadata": (self.archive_path / METADATA_MANIFEST_NAME,),
+        }
+        if self.text_metadata_path is not None:
+            sources["text_metadata"] = (self.text_metadata_path,)
+        return sources
+
+    def reload_if_changed(self):
+        """Reload the database, metadata and text metadata if their files changed."""
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            for name, paths in self._sources().items():
+                signature = tuple(_signature(path) for path in paths)
+                if self._signatures.get(name) == signature:
+                    continue
+                if name in self._signatures:
+                    print(f"Reloading {name}")
+                # Only recorded once loaded, so a failed load is tried again
+                getattr(self, f"_load_{name}")()
+                self._signatures[name] = signature
+            self._checked = now
+
+    def _load_database(self):
+        self.database.refresh()
+        slugs: dict[str, int] = {}
+        untagged: dict[str, int] = {}
+        # As in SlugIndexer, a source slug wins over the same original slug of a
+        # mapping entry, and otherwise the first entry with a slug wins
+        for field in ("source_slug", "original_slug"):
+            for entry in self.database:
+                slug = getattr(entry, field)
+                if slug:
+                    slugs.setdefault(slug, entry.text_id)
+                    # Also accept slugs without their source tag
+                    untagged.setdefault(slug.partition(":")[2] or slug, entry.text_id)
+        self._slugs = {**untagged, **slugs}
+
+    def _load_metadata(self):
+        store = MetadataStore(self.archive_path / METADATA_MANIFEST_NAME)
+        set_metadata_store(self.archive_path, store)
+
+    def _load_text_metadata(self):
+        self._text_metadata = load_text_metadata(self.text_metadata_path)
+
+    def find(
+        self,
+        text_id: int | None = None,
+        url: str | None = None,
+        slug: str | None = None,
+    ) -> URLDatabaseEntry | None:
+        self.reload_if_changed()
+        if text_id is not None:
+            return self.database.get_entry(text_id)
+        if url is not None:
+            return self.database.get_entry_by_url(url)
+        if slug is not None and slug in self._slugs:
+            return self.database.get_entry(self._slugs[slug])
+        return None
+
+    def entry_record(self, entry: URLDatabaseEntry) -> dict[str, Any]:
+        metadata = entry.metadata
+        return {
+            **{field: getattr(entry, field) for field in DATABASE_FIELDS},
+            "metadata": asdict(metadata) if metadata is not None else None,
+            "index": self._text_metadata.get(entry.text_id),
+            "content": entry.content_path.exists(),
+            "text": entry.text_path.exists(),
+        }
+
+    def member(self, entry: URLDatabaseEntry, member: str) -> CachedFile | None:
+        """The cached content or text of an entry."""
+        path = entry.content_path if member == "content" else entry.text_path
+        return self.cache.get((entry.text_id, member), path)
+
+
+def _json_body(value: Any) -> bytes:
+    return json.dumps(value, default=str, ensure_ascii=False).encode("utf-8")
+
+
+def _handler(service: ArchiveService):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are sent separately, which Nagle's algorithm would
+        # delay on keep-alive connections
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _respond(
+            self, status: int, body: bytes = b"", content_type: str | None = None
+        ):
+            self.send_response(status)
+            if content_type:
+                self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body and self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _respond_cached(self, body: bytes, content_type: str, etag: str):
+            if etag in self.headers.get("If-None-Match", "").split(", "):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _respond_json(self, value: Any):
+            body = _json_body(value)
+            self._respond_cached(body, CONTENT_TYPES["json"], _etag(body))
+
+        def _not_found(self, message: str):
+            self._respond(404, _json_body({"error": message}), CONTENT_TYPES["json"])
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+            if url.path == "/stats":
+                stats = _json_body(service.cache.stats())
+                self._respond(200, stats, CONTENT_TYPES["json"])
+                return
+
+            if url.path == "/lookup":
+                if "url" not in query and "slug" not in query:
+                    self._respond(
+                        400,
+                        _json_body({"error": "Give a url or slug to look up"}),
+                        CONTENT_TYPES["json"],
+                    )
+                    return
+                entry = service.find(url=query.get("url"), slug=query.get("slug"))
+                member = None
+            else:
+                match = _ENTRY_PATH.match(url.path)
+                if match is None:
+                    self._not_found(f"No such resource {url.path}")
+                    return
+                entry = service.find(text_id=int(match[1]))
+                member = match[2]
+
+            if entry is None:
+                self._not_found("No such entry")
+            elif member is None:
+                self._respond_json(service.entry_record(entry))
+            elif member == "metadata":
+                metadata = entry.metadata
+                if metadata is None:
+                    self._not_found(f"Entry {entry.text_id} has no metadata")
+                else:
+                    self._respond_json(asdict(metadata))
+            else:
+                cached = service.member(entry, member)
+                if cached is None:
+                    self._not_found(f"Entry {entry.text_id} has no {member}")
+                else:
+                    self._respond_cached(
+                        cached.data, CONTENT_TYPES[member], cached.etag
+                    )
+
+        do_HEAD = do_GET
+
+    return Handler
+
+
+def serve_archive(
+    service: ArchiveService, host: str = "127.0.0.1", port: int = 8080
+) -> ThreadingHTTPServer:
+    """Create a server for service. Call serve_forever on it to start serving."""
+    server = ThreadingHTTPServer((host, port), _handler(service))
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,270 @@
+import json
+import os
+import re
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from ceneton_texts_utils.url_database import (
+    METADATA_MANIFEST_NAME,
+    MetadataStore,
+    URLDatabase,
+    URLDatabaseEntry,
+    URLDatabaseJournal,
+    atomic_open,
+)
+
+SHARDS_FOLDER_NAME = "shards"
+# Records when the sharded run in a shards folder started
+RUN_FILE_NAME = "run.json"
+
+_SHARD_NAME = re.compile(r"^shard-(\d+)-of-(\d+)$")
+
+
+@dataclass(frozen=True)
+class Shard:
+    """One of `count` parts of the archive, numbered from 1.
+
+    Entries are assigned by their hundreds folder, so every archive folder is only
+    ever written by a single shard.
+    """
+
+    index: int
+    count: int
+    folder: Path
+
+    def __post_init__(self):
+        assert self.count > 0, "The number of shards must be positive"
+        assert 1 <= self.index <= self.count, (
+            f"Shard must be between 1 and {self.count}"
+        )
+
+    @classmethod
+    def parse(cls, spec: str, folder: Path) -> "Shard":
+        """Parse a shard given as "i/N"."""
+        index, _, count = spec.partition("/")
+        assert index.isdigit() and count.isdigit(), (
+            f"Shard must be given as i/N, not {spec}"
+        )
+        return cls(int(index), int(count), folder)
+
+    @classmethod
+    def for_database(cls, database: URLDatabase, spec: str) -> "Shard":
+        return cls.parse(spec, database.database_path.parent / SHARDS_FOLDER_NAME)
+
+    @property
+    def name(self) -> str:
+        return f"shard-{self.index}-of-{self.count}"
+
+    @property
+    def results_path(self) -> Path:
+        """Journal of the database updates made by the shard."""
+        return self.folder / f"{self.name}.jsonl"
+
+    @property
+    def metadata_path(self) -> Path:
+        """Manifest of the metadata saved by the shard."""
+        return self.folder / f"{self.name}.{METADATA_MANIFEST_NAME}"
+
+    @property
+    def lease_path(self) -> Path:
+        return self.folder / f"{self.name}.lease"
+
+    @property
+    def run_path(self) -> Path:
+        return self.folder / RUN_FILE_NAME
+
+    def run_started(self, now: datetime) -> datetime:
+        """The start time of the run this shard belongs to.
+
+        The first shard to start records now as the start of the run, and every
+        other shard uses that time, so the shards of a run share its run id.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        pending = self.folder / f".{RUN_FILE_NAME}.{socket.gethostname()}.{os.getpid()}"
+        with open(pending, "w") as f:
+            json.dump({"started": now.isoformat()}, f)
+        try:
+            # Linking fails if another shard recorded the run first, and never
+            # leaves a partly written run file
+            os.link(pending, self.run_path)
+            return now
+        except FileExistsError:
+            with open(self.run_path, "r") as f:
+                return datetime.fromisoformat(json.load(f)["started"])
+        finally:
+            pending.unlink()
+
+    def contains(self, entry: URLDatabaseEntry) -> bool:
+        return (entry.text_id // 100) % self.count == self.index - 1
+
+    def metadata_store(self, database: URLDatabase) -> MetadataStore:
+        """A store that reads the archive metadata but only writes the shard's."""
+        base_path = database.database_path.parent / METADATA_MANIFEST_NAME
+        return MetadataStore(self.metadata_path, base_path=base_path)
+
+
+def read_lease(lease_path: Path) -> dict[str, Any] | None:
+    try:
+        with open(lease_path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _lease_is_live(lease: dict[str, Any], timeout: float) -> bool:
+    return (
+        not lease.get("done")
+        and not lease.get("released")
+        and time.time() - lease["heartbeat"] < timeout
+    )
+
+
+class ShardLease:
+    """Claims a shard for this process, refreshing a heartbeat while it is held.
+
+    A shard whose heartbeat is older than `timeout` seconds is assumed to belong to
+    a stalled or dead worker, and can be reclaimed by another one. The lease is
+    a small JSON file next to the shard results, so it works across machines that
+    share the archive folder, as long as their clocks roughly agree.
+
+    Every heartbeat first checks that the lease is still ours. If another worker
+    reclaimed it, for example after this one stalled, the heartbeat stops and
+    `lost` is set, so the download can stop before it writes any more results.
+    """
+
+    def __init__(self, shard: Shard, timeout: float = 600):
+        self.shard = shard
+        self.timeout = timeout
+        # Several heartbeats per timeout, so a slow write does not lose the lease
+        self.interval = timeout / 5
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _write(self, **state: bool):
+        record = {"owner": self.owner, "heartbeat": time.time(), **state}
+        with atomic_open(self.shard.lease_path, "w") as f:
+            json.dump(record, f)
+
+    def acquire(self) -> dict[str, Any] | None:
+        """Take the lease, returning the lease of a previous owner if it had one."""
+        self.shard.folder.mkdir(parents=True, exist_ok=True)
+        previous = read_lease(self.shard.lease_path)
+        if previous is not None:
+            assert not previous.get("done"), (
+                f"Shard {self.shard.name} is already complete, merge it first"
+            )
+            assert not _lease_is_live(previous, self.timeout), (
+                f"Shard {self.shard.name} is held by {previous['owner']}"
+            )
+
+        self._write()
+        # Another worker may have reclaimed the lease at the same time. The last
+        # write wins, so check that it was ours.
+        time.sleep(min(1.0, self.interval / 10))
+        current = read_lease(self.shard.lease_path)
+        assert current is not None and current["owner"] == self.owner, (
+            f"Shard {self.shard.name} was claimed by {current and current['owner']}"
+        )
+
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+        return previous
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.interval):
+            current = read_lease(self.shard.lease_path)
+            if current is None or current["owner"] != self.owner:
+                print(
+                    f"Lost the lease on {self.shard.name} to "
+                    f"{current and current['owner']}, stopping"
+                )
+                self.lost.set()
+                return
+            self._write()
+
+    def release(self, done: bool = False):
+        """Give up the lease, marking the shard as complete if done.
+
+        A lease that was lost to another worker is left to it.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.lost.is_set():
+            return
+        if done:
+            self._write(done=True)
+        else:
+            self._write(released=True)
+
+
+def find_shards(folder: Path) -> list[Shard]:
+    shards = []
+    for path in folder.glob("shard-*.lease"):
+        match = _SHARD_NAME.match(path.name.removesuffix(".lease"))
+        if match:
+            shards.append(Shard(int(match[1]), int(match[2]), folder))
+    return sorted(shards, key=lambda s: (s.count, s.index))
+
+
+def merge_shards(
+    database: URLDatabase, folder: Path, partial: bool = False, timeout: float = 600
+) -> int:
+    """Fold the results of every shard in folder into the database.
+
+    Shards that are still running are never merged. Shards that stopped before
+    completing are only merged with partial, and are then removed like the
+    others: entries they did not get to are simply not updated.
+
+    Returns the number of entry updates applied.
+    """
+    shards = find_shards(folder)
+    assert shards, f"No shards found in {folder}"
+
+    counts = {shard.count for shard in shards}
+    assert len(counts) == 1, f"Shards of different runs in {folder}: {counts}"
+    missing = set(range(1, counts.pop() + 1)) - {shard.index for shard in shards}
+    assert partial or not missing, f"Missing shards: {sorted(missing)}"
+
+    for shard in shards:
+        lease = read_lease(shard.lease_path)
+        assert lease is not None, f"Lease of {shard.name} is unreadable"
+        assert not _lease_is_live(lease, timeout), (
+            f"Shard {shard.name} is still running on {lease['owner']}"
+        )
+        assert partial or lease.get("done"), f"Shard {shard.name} is incomplete"
+
+    applied = 0
+    with database.batch():
+        for shard in shards:
+            if not shard.results_path.exists():
+                continue
+            _, updates = URLDatabaseJournal.read(shard.results_path)
+            for text_id, values in updates:
+                if text_id in database:
+                    database.update_entry(text_id, **values)
+                    applied += 1
+    database.save_database()
+
+    metadata_store = database.metadata_store
+    for shard in shards:
+        metadata_store.merge(shard.metadata_path)
+    metadata_store.sync(database)
+
+    for shard in shards:
+        shard.results_path.unlink(missing_ok=True)
+        shard.metadata_path.unlink(missing_ok=True)
+        shard.lease_path.unlink()
+    (folder / RUN_FILE_NAME).unlink(missing_ok=True)
+
+    print(f"Merged {applied} updates from {len(shards)} shards")
+    return applied
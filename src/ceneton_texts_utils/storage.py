@@ -0,0 +1,114 @@
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from tqdm import tqdm
+
+from ceneton_texts_utils.compression import CODECS, Codec, open_stored, stored_codec
+from ceneton_texts_utils.url_database import (
+    CONTENT_NAME,
+    TEXT_NAME,
+    URLDatabase,
+    open_for_write,
+)
+
+
+def compress_archive(
+    database: URLDatabase, codec: Codec | None, include_text: bool = True
+) -> tuple[int, int, int]:
+    """Store the content (and text) of every entry with codec.
+
+    Use None as the codec to decompress the archive again. Returns the number of
+    files converted and their total size before and after.
+    """
+    names = [CONTENT_NAME, TEXT_NAME] if include_text else [CONTENT_NAME]
+
+    converted = 0
+    size_before = 0
+    size_after = 0
+    for entry in tqdm(list(database)):
+        for name in names:
+            base_path = entry.archive_folder / name
+            path = entry.content_path if name == CONTENT_NAME else entry.text_path
+            if not path.exists() or stored_codec(path) == codec:
+                continue
+
+            size_before += path.stat().st_size
+            with open_stored(path) as f:
+                data = f.read()
+            with open_for_write(base_path, codec) as f:
+                f.write(data)
+
+            new_path = base_path if codec is None else codec.path_for(base_path)
+            size_after += new_path.stat().st_size
+            converted += 1
+
+    return converted, size_before, size_after
+
+
+@dataclass
+class CodecReport:
+    codec: str
+    raw_bytes: int
+    stored_bytes: int
+    write_seconds: float
+    read_seconds: float
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.stored_bytes if self.stored_bytes else 0.0
+
+    @property
+    def write_mb_per_second(self) -> float:
+        return self.raw_bytes / 1e6 / self.write_seconds if self.write_seconds else 0
+
+    @property
+    def read_mb_per_second(self) -> float:
+        return self.raw_bytes / 1e6 / self.read_seconds if self.read_seconds else 0
+
+
+def storage_report(database: URLDatabase, sample_size: int = 200) -> list[CodecReport]:
+    """Compare the compression ratio and read throughput of every available codec.
+
+    An evenly spread sample of the archived pages is written with each codec to a
+    temporary folder and read back the way `URLDatabaseEntry.content` reads it.
+    """
+    entries = [e for e in database if e.content_path.exists()]
+    step = max(1, len(entries) // sample_size)
+    samples = [entry.content for entry in entries[::step][:sample_size]]
+    raw_bytes = sum(len(s) for s in samples)
+
+    reports = []
+    codecs: list[Codec | None] = [None, *CODECS.values()]
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in codecs:
+            folder = Path(tmp) / (codec.name if codec else "none")
+            folder.mkdir()
+
+            start = time.perf_counter()
+            paths = []
+            for i, data in enumerate(samples):
+                base_path = folder / f"{i}.html"
+                with open_for_write(base_path, codec) as f:
+                    f.write(data)
+                paths.append(base_path if codec is None else codec.path_for(base_path))
+            write_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for path in paths:
+                with open_stored(path) as f:
+                    f.read()
+            read_seconds = time.perf_counter() - start
+
+            reports.append(
+                CodecReport(
+                    codec=codec.name if codec else "none",
+                    raw_bytes=raw_bytes,
+                    stored_bytes=sum(p.stat().st_size for p in paths),
+                    write_seconds=write_seconds,
+                    read_seconds=read_seconds,
+                )
+            )
+
+    return reports
@@ -1,7 +1,15 @@
 import csv
+import fcntl
 import hashlib
+import json
+import os
 import sqlite3
-from dataclasses import asdict, dataclass
+import tempfile
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
 from pathlib import Path
 from typing import Any
@@ -9,8 +17,67 @@ from urllib.parse import urljoin
 
 import yaml
 
+from ceneton_texts_utils import metrics
+from ceneton_texts_utils.compression import (
+    Codec,
+    open_stored,
+    remove_other_variants,
+    stored_path,
+)
+
 CENETON_ROOT_URL = "https://www.let.leidenuniv.nl/Dutch/Ceneton/"
 
+CSV_DATABASE_NAME = "index.csv"
+SQLITE_DATABASE_NAME = "index.sqlite"
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+METADATA_MANIFEST_NAME = "metadata.jsonl"
+CONTENT_NAME = "content.html"
+TEXT_NAME = "content.txt"
+
+# Use the libyaml bindings when they are available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# mkstemp creates files readable only by the owner, so we restore the permissions a
+# plain open() would have given the file
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextmanager
+def atomic_open(path: Path, mode: str = "w"):
+    """Open a temporary file next to path that replaces path once closed.
+
+    If the block raises, the temporary file is removed and path is left untouched.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def open_for_write(path: Path, codec: Codec | None = None):
+    """Atomically replace a stored file, compressing it with codec.
+
+    Any copy of the file stored with a different codec is removed once the new one
+    is in place.
+    """
+    target_path = path if codec is None else codec.path_for(path)
+    with atomic_open(target_path, "wb") as f:
+        if codec is None:
+            yield f
+        else:
+            with codec.writer(f) as compressed:
+                yield compressed
+
+    remove_other_variants(path, keep=target_path)
+
 
 @dataclass
 class URLDatabaseEntryMetadata:
@@ -20,10 +87,258 @@ class URLDatabaseEntryMetadata:
     last_modified: str | None = None
     content_length: int | None = None
     sha256: str | None = None
+    # The sha256 of the HTML content.txt was converted from, and the converter used
+    text_source_sha256: str | None = None
+    text_converter: str | None = None
+    # Content history, used to schedule recrawls
+    first_downloaded: datetime | None = None
+    last_changed: datetime | None = None
+    changes: int = 0
+    # Failed checks since the last successful one
+    failures: int = 0
+
+    def __post_init__(self):
+        for name in ("last_attempt", "first_downloaded", "last_changed"):
+            value = getattr(self, name)
+            if isinstance(value, str):
+                setattr(self, name, datetime.fromisoformat(value))
+
+
+class MetadataStore:
+    """The metadata of every entry in an archive, kept in a single manifest file.
+
+    The manifest is a JSON-lines file that is loaded with one read the first time
+    any metadata is accessed. Saving metadata appends a line to the manifest, and
+    later lines win. Entries missing from the manifest fall back to their
+    metadata.yml file.
+
+    The per-entry metadata.yml files are not written when metadata is saved, but in
+    bulk by `sync`, which also compacts the manifest. The first line of a compacted
+    manifest records how many entries it holds, so any lines after those are known
+    to still need exporting, even after a crash. Entries without stored content, such
+    as URLs that have only ever failed, keep their metadata in the manifest alone, so
+    no archive folder is created for them.
+
+    Several processes may save to the same manifest, for example a download and a
+    text conversion. Appending and compacting both hold a lock file next to the
+    manifest, and compaction first reads the lines other processes appended since
+    the manifest was loaded, so none of them are lost.
+
+    With a base_path, the store starts from the metadata in that manifest but only
+    ever writes to its own, leaving the base manifest untouched.
+    """
+
+    def __init__(self, manifest_path: Path, base_path: Path | None = None):
+        self.manifest_path = manifest_path
+        self.base_path = base_path
+        self._lock = threading.Lock()
+        self._metadata: dict[int, dict[str, Any]] | None = None
+        self._unexported: set[int] = set()
+        # The inode of the manifest as loaded, and the offset read up to
+        self._position: tuple[int, int] | None = None
+
+    @staticmethod
+    def _read(
+        manifest_path: Path, offset: int = 0
+    ) -> tuple[list[tuple[int, dict[str, Any], bool]], tuple[int, int] | None]:
+        """Read the records of a manifest from offset as (text_id, data, exported).
+
+        Also returns the inode of the manifest and the offset after its last
+        complete line, or None if there is no manifest.
+        """
+        try:
+            f = open(manifest_path, "rb")
+        except FileNotFoundError:
+            return [], None
+
+        records = []
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            f.seek(offset)
+            compacted = 0
+            for line_no, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a process that was killed
+                    break
+                if not line.endswith(b"\n"):
+                    # A final line that is still being written
+                    break
+                offset += len(line)
+                if offset == len(line) and "compacted" in record:
+                    compacted = record["compacted"] + 1
+                    continue
+                text_id = record.pop("text_id")
+                records.append((text_id, record, line_no < compacted))
+        return records, (inode, offset)
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock on the manifest that other processes also take."""
+        lock_path = self.manifest_path.with_name(f".{self.manifest_path.name}.lock")
+        with open(lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _append(self, records: Iterable[tuple[int, dict[str, Any]]]):
+        lines = "".join(
+            json.dumps({"text_id": text_id, **data}, default=str) + "\n"
+            for text_id, data in records
+        )
+        with self._locked(), open(self.manifest_path, "a") as f:
+            f.write(lines)
+
+    def _load(self) -> dict[int, dict[str, Any]]:
+        if self._metadata is not None:
+            return self._metadata
+
+        metadata = {}
+        if self.base_path is not None:
+            for text_id, record, _ in self._read(self.base_path)[0]:
+                metadata[text_id] = record
+        records, self._position = self._read(self.manifest_path)
+        for text_id, record, exported in records:
+            metadata[text_id] = record
+            if not exported:
+                self._unexported.add(text_id)
+
+        self._metadata = metadata
+        return metadata
+
+    def _load_appended(self):
+        """Apply the lines appended to the manifest since it was loaded.
+
+        Must hold the lock on the manifest, so it is not replaced meanwhile. If
+        another process compacted it, the whole manifest is read again, which
+        includes everything this store saved.
+        """
+        metadata = self._load()
+        offset = 0
+        if self._position is not None and self.manifest_path.exists():
+            inode, loaded_offset = self._position
+            if self.manifest_path.stat().st_ino == inode:
+                offset = loaded_offset
+
+        records, self._position = self._read(self.manifest_path, offset)
+        for text_id, record, exported in records:
+            metadata[text_id] = record
+            if not exported:
+                self._unexported.add(text_id)
+
+    def get(self, entry: "URLDatabaseEntry") -> URLDatabaseEntryMetadata | None:
+        with self._lock:
+            metadata = self._load()
+            data = metadata.get(entry.text_id)
+            if data is None and entry.metadata_path.exists():
+                with open(entry.metadata_path, "r") as f:
+                    data = yaml.load(f, Loader=YAML_LOADER)
+                metadata[entry.text_id] = data
+
+        if data is None:
+            return None
+        return URLDatabaseEntryMetadata(**data)
+
+    def save(self, entry: "URLDatabaseEntry", metadata: URLDatabaseEntryMetadata):
+        data = asdict(metadata)
+        with self._lock, metrics.timed("save_metadata_seconds"):
+            self._load()[entry.text_id] = data
+            self._unexported.add(entry.text_id)
+            self._append([(entry.text_id, data)])
+
+    def merge(self, manifest_path: Path) -> int:
+        """Save every record in another manifest to this store, returning the count.
+
+        The merged entries are exported on the next sync.
+        """
+        records = [(text_id, data) for text_id, data, _ in self._read(manifest_path)[0]]
+        with self._lock:
+            metadata = self._load()
+            for text_id, data in records:
+                metadata[text_id] = data
+                self._unexported.add(text_id)
+            self._append(records)
+        return len(records)
+
+    def export_yaml(self, entries: Iterable["URLDatabaseEntry"]) -> int:
+        """Write the metadata.yml files of the given entries from the manifest.
+
+        Entries without stored content are left out. Returns the number written.
+        """
+        metadata = self._load()
+        exported = 0
+        for entry in entries:
+            data = metadata.get(entry.text_id)
+            if data is None or data.get("sha256") is None:
+                continue
+            entry.archive_folder.mkdir(parents=True, exist_ok=True)
+            with atomic_open(entry.metadata_path, "w") as f:
+                yaml.dump(
+                    asdict(URLDatabaseEntryMetadata(**data)), f, Dumper=YAML_DUMPER
+                )
+            exported += 1
+        return exported
+
+    def sync(self, database: "URLDatabase", export_all: bool = False):
+        """Export changed metadata.yml files and compact the manifest."""
+        with self._lock, metrics.timed("metadata_sync_seconds"), self._locked():
+            self._load_appended()
+            metadata = self._load()
+            text_ids = metadata.keys() if export_all else self._unexported
+            entries = [database.get_entry(i) for i in sorted(text_ids)]
+            exported = self.export_yaml(e for e in entries if e is not None)
+
+            with atomic_open(self.manifest_path, "w") as f:
+                f.write(json.dumps({"compacted": len(metadata)}) + "\n")
+                for text_id in sorted(metadata):
+                    record = {"text_id": text_id, **metadata[text_id]}
+                    f.write(json.dumps(record, default=str) + "\n")
+            # Nothing can be appended while the lock is held
+            stat = self.manifest_path.stat()
+            self._position = stat.st_ino, stat.st_size
+
+            print(f"Exported metadata for {exported} entries")
+            self._unexported.clear()
+
+    def load_yaml(self, entries: Iterable["URLDatabaseEntry"]):
+        """Read the metadata.yml files of the given entries into the manifest."""
+        with self._lock:
+            metadata = self._load()
+            for entry in entries:
+                if entry.metadata_path.exists():
+                    with open(entry.metadata_path, "r") as f:
+                        metadata[entry.text_id] = yaml.load(f, Loader=YAML_LOADER)
+
+
+_metadata_stores: dict[Path, MetadataStore] = {}
+_metadata_stores_lock = threading.Lock()
+
+
+def get_metadata_store(archive_path: Path) -> MetadataStore:
+    """Return the shared metadata store for the archive in archive_path."""
+    archive_path = archive_path.absolute()
+    with _metadata_stores_lock:
+        store = _metadata_stores.get(archive_path)
+        if store is None:
+            store = MetadataStore(archive_path / METADATA_MANIFEST_NAME)
+            _metadata_stores[archive_path] = store
+        return store
 
 
-@dataclass(frozen=True)
+def set_metadata_store(archive_path: Path, store: MetadataStore):
+    """Use store for all metadata of the archive in archive_path from now on."""
+    with _metadata_stores_lock:
+        _metadata_stores[archive_path.absolute()] = store
+
+
+@dataclass(frozen=True, slots=True)
 class URLDatabaseEntry:
+    """A single text in the database.
+
+    Entries are read-only to everyone but the URLDatabase that holds them, which
+    updates their fields in place.
+    """
+
     text_id: int
     url: str
     source_slug: str
@@ -35,6 +350,10 @@ class URLDatabaseEntry:
     comments: str | None = None
 
     def __post_init__(self):
+        self._coerce_fields()
+
+    def _coerce_fields(self):
+        """Convert fields read from the database file to their types."""
         object.__setattr__(self, "text_id", int(self.text_id))
 
         if self.last_status:
@@ -59,35 +378,367 @@ class URLDatabaseEntry:
         return self.archive_folder / "metadata.yml"
 
     @property
-    def metadata(self) -> URLDatabaseEntryMetadata:
-        if self.metadata_path.exists():
-            return URLDatabaseEntryMetadata(
-                **yaml.safe_load(self.metadata_path.read_text())
-            )
+    def metadata_store(self) -> MetadataStore:
+        return get_metadata_store(self.database_path.parent)
+
+    @property
+    def metadata(self) -> URLDatabaseEntryMetadata | None:
+        return self.metadata_store.get(self)
 
     @property
     def content_path(self) -> Path:
-        return self.archive_folder / "content.html"
+        """The path content.html is stored under, which may be compressed."""
+        return stored_path(self.archive_folder / CONTENT_NAME)
+
+    @property
+    def text_path(self) -> Path:
+        """The path content.txt is stored under, which may be compressed."""
+        return stored_path(self.archive_folder / TEXT_NAME)
+
+    @property
+    def text_version(self) -> str | None:
+        """Identify the current version of the entry's text without reading it.
+
+        The source HTML hash and converter determine the text, with the file size
+        as a cheap guard against texts edited by hand. Texts without a conversion
+        record fall back to the file's size and modification time.
+        """
+        text_path = self.text_path
+        if not text_path.exists():
+            return None
+
+        stat = text_path.stat()
+        metadata = self.metadata
+        if metadata is not None and metadata.text_source_sha256:
+            return (
+                f"{metadata.text_source_sha256}:{metadata.text_converter}:"
+                f"{stat.st_size}"
+            )
+
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
 
     @property
     def content(self) -> bytes:
-        with open(self.content_path, "rb") as f:
+        with open_stored(self.content_path) as f:
             return f.read()
 
+    @property
+    def text(self) -> str:
+        with open_stored(self.text_path) as f:
+            return f.read().decode("utf-8")
+
     def save_metadata(self, metadata: URLDatabaseEntryMetadata):
-        self.archive_folder.mkdir(parents=True, exist_ok=True)
-        with open(self.metadata_path, "w") as f:
-            yaml.dump(asdict(metadata), f)
+        """Save metadata to the manifest. metadata.yml is written on the next sync."""
+        self.metadata_store.save(self, metadata)
 
-    def save_content(self, content: bytes):
+    def save_content(self, content: bytes, codec: Codec | None = None):
         self.archive_folder.mkdir(parents=True, exist_ok=True)
-        with open(self.content_path, "wb") as f:
+        with (
+            metrics.timed("save_content_seconds"),
+            open_for_write(self.archive_folder / CONTENT_NAME, codec) as f,
+        ):
             f.write(content)
 
+    def save_text(self, text: str, codec: Codec | None = None):
+        self.archive_folder.mkdir(parents=True, exist_ok=True)
+        with (
+            metrics.timed("save_text_seconds"),
+            open_for_write(self.archive_folder / TEXT_NAME, codec) as f,
+        ):
+            f.write(text.encode("utf-8"))
+
+    def save_content_stream(
+        self,
+        chunks: Iterable[bytes],
+        metadata: URLDatabaseEntryMetadata,
+        codec: Codec | None = None,
+    ) -> URLDatabaseEntryMetadata:
+        """Stream content to disk and commit it together with its metadata.
+
+        The content is hashed and counted as it is written to a temporary file, so
+        memory use does not depend on the size of the page. Content is committed
+        before metadata: if we are interrupted in between, the old metadata makes
+        sure the page is fetched again on the next run.
+
+        The sha256 and content_length are always those of the uncompressed content.
+        The time recorded for saving includes reading the chunks, so for downloads
+        it covers the transfer of the response body.
+        """
+        self.archive_folder.mkdir(parents=True, exist_ok=True)
+
+        sha256 = hashlib.sha256()
+        content_length = 0
+        with (
+            metrics.timed("save_content_seconds"),
+            open_for_write(self.archive_folder / CONTENT_NAME, codec) as f,
+        ):
+            for chunk in chunks:
+                sha256.update(chunk)
+                content_length += len(chunk)
+                f.write(chunk)
+
+        # metadata still has the sha256 of the previous download, if any
+        if metadata.sha256 != sha256.hexdigest():
+            if metadata.sha256 is None:
+                metadata.first_downloaded = metadata.last_attempt
+            else:
+                metadata.changes += 1
+            metadata.last_changed = metadata.last_attempt
+
+        metadata.sha256 = sha256.hexdigest()
+        metadata.content_length = content_length
+        self.save_metadata(metadata)
+
+        return metadata
+
+
+DATABASE_FIELDS = [
+    f for f in URLDatabaseEntry.__dataclass_fields__.keys() if f != "database_path"
+]
+
+
+def _entry_row(entry: URLDatabaseEntry) -> dict[str, Any]:
+    return {f: getattr(entry, f) for f in DATABASE_FIELDS}
+
+
+class CSVDatabaseBackend:
+    """Stores the database as a single CSV file that is rewritten on every save."""
+
+    incremental = False
+
+    def __init__(self, database_path: Path):
+        self.database_path = database_path
+
+    def create(self):
+        with open(self.database_path, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=DATABASE_FIELDS)
+            writer.writeheader()
+
+    def load(self) -> Iterator[dict[str, Any]]:
+        with open(self.database_path, "r") as f:
+            yield from csv.DictReader(f)
+
+    def write_all(self, entries: Iterable[URLDatabaseEntry]):
+        with atomic_open(self.database_path, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=DATABASE_FIELDS)
+            writer.writeheader()
+            for entry in entries:
+                writer.writerow(_entry_row(entry))
+        print(f"Saved database to {self.database_path}")
+
+    def write_entry(self, entry: URLDatabaseEntry):
+        raise NotImplementedError("CSV databases are only written as a whole")
+
+    def write_entries(self, entries: Iterable[URLDatabaseEntry]):
+        raise NotImplementedError("CSV databases are only written as a whole")
+
+
+class SQLiteDatabaseBackend:
+    """Stores the database in a WAL-mode SQLite file with one row per entry.
+
+    Every change is written as its own small transaction, so there is nothing left
+    to do when the database is saved. sqlite3 connections can only be used on the
+    thread that opened them, so every thread gets a connection of its own, for
+    example the request threads of the archive server that reload the database.
+    """
+
+    incremental = True
+
+    def __init__(self, database_path: Path):
+        self.database_path = database_path
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.database_path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def create(self):
+        with self.conn:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    text_id INTEGER PRIMARY KEY,
+                    url TEXT NOT NULL UNIQUE,
+                    source_slug TEXT,
+                    skip TEXT,
+                    original_slug TEXT,
+                    last_status INTEGER,
+                    last_checked TEXT,
+                    comments TEXT
+                );
+                CREATE INDEX IF NOT EXISTS entries_source_slug
+                    ON entries (source_slug);
+                CREATE INDEX IF NOT EXISTS entries_original_slug
+                    ON entries (original_slug);
+                """
+            )
+
+    def load(self) -> Iterator[dict[str, Any]]:
+        cursor = self.conn.execute(
+            f"SELECT {', '.join(DATABASE_FIELDS)} FROM entries ORDER BY text_id"
+        )
+        for row in cursor:
+            yield dict(zip(DATABASE_FIELDS, row))
+
+    def _insert(self, entries: Iterable[URLDatabaseEntry]):
+        placeholders = ", ".join("?" for _ in DATABASE_FIELDS)
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO entries ({', '.join(DATABASE_FIELDS)}) "
+            f"VALUES ({placeholders})",
+            (
+                [_sqlite_value(getattr(entry, f)) for f in DATABASE_FIELDS]
+                for entry in entries
+            ),
+        )
+
+    def write_all(self, entries: Iterable[URLDatabaseEntry]):
+        with self.conn:
+            self.conn.execute("DELETE FROM entries")
+            self._insert(entries)
+        print(f"Saved database to {self.database_path}")
+
+    def write_entry(self, entry: URLDatabaseEntry):
+        self.write_entries([entry])
+
+    def write_entries(self, entries: Iterable[URLDatabaseEntry]):
+        with self.conn:
+            self._insert(entries)
+
+
+def _sqlite_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        # Same representation as the CSV database
+        return str(value)
+    if value == "":
+        # Empty CSV cells are unset fields, as in entries created by the database
+        return None
+    return value
+
+
+def database_backend(database_path: Path):
+    if database_path.suffix in SQLITE_SUFFIXES:
+        return SQLiteDatabaseBackend(database_path)
+    return CSVDatabaseBackend(database_path)
+
+
+def find_database(database_folder: str | Path) -> Path:
+    """Return the database in a folder, preferring SQLite over CSV if both exist."""
+    database_folder = Path(database_folder)
+    sqlite_path = database_folder / SQLITE_DATABASE_NAME
+    if sqlite_path.exists():
+        return sqlite_path
+    return database_folder / CSV_DATABASE_NAME
+
+
+class URLDatabaseJournal:
+    """Append-only JSON-lines log of the entry updates made during a run.
+
+    Every record is written to the file straight away, so it survives the process
+    being killed, but the file is only fsynced every `fsync_every` records or
+    `fsync_interval` seconds.
+
+    The first line records when the run started, so an interrupted run can be
+    resumed.
+    """
+
+    def __init__(
+        self,
+        journal_path: Path,
+        run_started: datetime,
+        fsync_every: int = 50,
+        fsync_interval: float = 5.0,
+        append: bool = False,
+    ):
+        self.journal_path = journal_path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+
+        append = append and journal_path.exists()
+        if append:
+            # Drop a torn final line, which would hide everything appended after it
+            with open(journal_path, "rb+") as f:
+                f.truncate(f.read().rfind(b"\n") + 1)
+
+        self._file = open(journal_path, "a" if append else "w")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        if not append:
+            self._write({"run_started": run_started.isoformat()})
+        self.sync()
+
+    def _write(self, record: dict[str, Any]):
+        self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+
+    def append(self, text_id: int, values: dict[str, Any]):
+        self._write({"text_id": text_id, "values": values})
+        self._unsynced += 1
+        if (
+            self._unsynced >= self.fsync_every
+            or time.monotonic() - self._last_sync >= self.fsync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        if self._file.closed:
+            return
+        with metrics.timed("journal_sync_seconds"):
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    @staticmethod
+    def read(
+        journal_path: Path,
+    ) -> tuple[datetime | None, list[tuple[int, dict[str, Any]]]]:
+        run_started = None
+        updates = []
+        with open(journal_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a process that was killed mid-write
+                    break
+                if "run_started" in record:
+                    run_started = datetime.fromisoformat(record["run_started"])
+                else:
+                    updates.append((record["text_id"], record["values"]))
+        return run_started, updates
+
 
 class URLDatabase:
-    def __init__(self, database_path: str | Path, create_if_missing: bool = False):
+    def __init__(
+        self,
+        database_path: str | Path,
+        create_if_missing: bool = False,
+        read_only: bool = False,
+        replay_journal: bool = False,
+    ):
+        """Load the database in database_path.
+
+        Updates in the journal of a run that is still going, or was interrupted,
+        are not visible until that run completes or is resumed. Only the download
+        that owns the journal should load with replay_journal, which folds the
+        updates of an interrupted run into the database so it can be resumed. Any
+        other process doing so would replace the journal under a running download.
+
+        A read_only database never writes to the database.
+        """
+        assert not (read_only and replay_journal), "Cannot replay a read-only database"
         self.database_path = Path(database_path)
+        self.read_only = read_only
+        self.replay_journal = replay_journal
         if create_if_missing and not self.database_path.exists():
             create_new_database(self.database_path)
 
@@ -95,55 +746,156 @@ class URLDatabase:
             f"Database file {self.database_path} does not exist"
         )
 
+        self.backend = database_backend(self.database_path)
         self.database_entries: dict[int, URLDatabaseEntry] = {}
+        # Kept up to date by every change, so lookups by url never rebuild it
+        self.database_entries_by_url: dict[str, URLDatabaseEntry] = {}
+        self.next_id = 1
+        # Entries changed inside a batch block, written when it ends
+        self._batch: dict[int, URLDatabaseEntry] | None = None
 
-        self.refresh()
+        self.journal: URLDatabaseJournal | None = None
+        # Whether updates only go to a journal of their own, see start_journal
+        self._journal_only = False
+        # Start time of a run that was interrupted before it completed
+        self.interrupted_run: datetime | None = None
 
-    @property
-    def database_entries_by_url(self) -> dict[str, URLDatabaseEntry]:
-        if self.database_is_dirty:
-            url_dict = {entry.url: entry for entry in self.database_entries.values()}
-            object.__setattr__(self, "_database_entries_by_url", url_dict)
-
-        return object.__getattribute__(self, "_database_entries_by_url")
-
-    @property
-    def database_is_dirty(self) -> bool:
-        return not hasattr(self, "_database_entries_by_url")
-
-    @database_is_dirty.setter
-    def database_is_dirty(self, value: bool):
-        if value and hasattr(self, "_database_entries_by_url"):
-            object.__delattr__(self, "_database_entries_by_url")
+        self.refresh()
 
     def refresh(self):
-        with open(self.database_path, "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
+        """Load the entries from the database file, replacing any loaded before.
+
+        The entries are swapped in at once, so threads reading the database while
+        it is refreshed see either the old or the new entries.
+        """
+        entries: dict[int, URLDatabaseEntry] = {}
+        with metrics.timed("load_database_seconds"):
+            for row in self.backend.load():
                 id = int(row.pop("text_id"))
                 entry = URLDatabaseEntry(
                     text_id=id, database_path=self.database_path, **row
                 )
-                self.database_entries[id] = entry
-        self.database_is_dirty = True
+                entries[id] = entry
+        self.database_entries = entries
+
+        self.database_entries_by_url = {
+            entry.url: entry for entry in self.database_entries.values()
+        }
+        self.next_id = max(self.database_entries, default=0) + 1
+
+        if self.replay_journal and self.journal_path.exists():
+            self._replay_journal()
+
+    @property
+    def journal_path(self) -> Path:
+        return self.database_path.with_name(f"{self.database_path.stem}.journal.jsonl")
+
+    def _replay_journal(self):
+        """Apply updates left in the journal by an interrupted run, then compact.
+
+        The updates are folded into the database file and the journal is truncated
+        to its header, so the interrupted run can still be resumed.
+        """
+        run_started, updates = URLDatabaseJournal.read(self.journal_path)
+        for text_id, values in updates:
+            if text_id in self.database_entries:
+                self.update_entry(text_id, **values)
+
+        if updates:
+            print(f"Replayed {len(updates)} updates from {self.journal_path}")
+            self.save_database()
+
+        self.interrupted_run = run_started
+        if run_started is None:
+            self.journal_path.unlink()
+        else:
+            with atomic_open(self.journal_path, "w") as f:
+                f.write(json.dumps({"run_started": run_started.isoformat()}) + "\n")
+
+    def start_journal(
+        self, run_started: datetime, journal_path: Path | None = None, **kwargs: Any
+    ):
+        """Record every update_entry in the journal until finish_journal is called.
+
+        journal_path defaults to the journal next to the database, which is
+        replayed by the next download. With a journal_path of its own, updates only
+        go to that journal and the database is not written at all until the
+        journal is detached, as for a shard worker whose results are merged later.
+        """
+        assert self.journal is None, "Journal already started"
+        self.journal = URLDatabaseJournal(
+            journal_path or self.journal_path, run_started, **kwargs
+        )
+        self._journal_only = journal_path is not None
+
+    def detach_journal(self):
+        """Stop recording updates, leaving the journal in place and unsaved."""
+        assert self.journal is not None, "Journal not started"
+        self.journal.close()
+        self.journal = None
+        self._journal_only = False
+
+    def finish_journal(self):
+        """Save the database and remove the journal of a completed run."""
+        assert self.journal is not None, "Journal not started"
+        assert not self._journal_only, "Updates were only recorded in the journal"
+        self.journal.close()
+        self.journal = None
+        self.save_database()
+        self.journal_path.unlink()
+        self.interrupted_run = None
 
     def save_database(self):
+        assert not self.read_only, "The database is read-only"
+        if self.backend.incremental:
+            # Every change has already been written
+            return
+
         entries = sorted(self.database_entries.values(), key=lambda x: x.text_id)
+        with metrics.timed("save_database_seconds"):
+            self.backend.write_all(entries)
 
-        skip_headers = ["database_path"]
-        headers = [
-            h
-            for h in URLDatabaseEntry.__dataclass_fields__.keys()
-            if h not in skip_headers
-        ]
+    @contextmanager
+    def batch(self):
+        """Write the entries added or updated in the block in a single transaction.
 
-        with open(self.database_path, "w") as f:
-            writer = csv.DictWriter(f, fieldnames=headers)
-            writer.writeheader()
-            for entry in entries:
-                entry_dict = {k: v for k, v in asdict(entry).items() if k in headers}
-                writer.writerow(entry_dict)
-        print(f"Saved database to {self.database_path}")
+        Without a batch, an incremental backend writes every change on its own.
+        """
+        assert self._batch is None, "Batch already started"
+        self._batch = {}
+        try:
+            yield
+        finally:
+            entries, self._batch = self._batch, None
+            if entries and self.backend.incremental:
+                self.backend.write_entries(entries.values())
+
+    def _write_entry(self, entry: URLDatabaseEntry):
+        assert not self.read_only, "The database is read-only"
+        if self._journal_only:
+            return
+        if self._batch is not None:
+            self._batch[entry.text_id] = entry
+        elif self.backend.incremental:
+            self.backend.write_entry(entry)
+
+    @property
+    def metadata_store(self) -> MetadataStore:
+        return get_metadata_store(self.database_path.parent)
+
+    def export_database(self, target_path: str | Path):
+        """Write a full copy of this database to target_path.
+
+        The format is chosen from the file extension, so this converts between the
+        CSV and SQLite backends.
+        """
+        target_path = Path(target_path)
+        backend = database_backend(target_path)
+        if not target_path.exists():
+            backend.create()
+
+        entries = sorted(self.database_entries.values(), key=lambda x: x.text_id)
+        backend.write_all(entries)
 
     def add_entry(self, **values: Any) -> URLDatabaseEntry:
         assert "url" in values, "url is a required field"
@@ -155,16 +907,13 @@ class URLDatabase:
             "text_id is a reserved field and should not be provided"
         )
 
-        if len(self.database_entries) == 0:
-            next_id = 1
-        else:
-            next_id = max(self.database_entries.keys()) + 1
-
-        values["text_id"] = next_id
+        values["text_id"] = self.next_id
         entry = URLDatabaseEntry(database_path=self.database_path, **values)
         self.database_entries[entry.text_id] = entry
+        self.database_entries_by_url[entry.url] = entry
+        self.next_id += 1
+        self._write_entry(entry)
 
-        self.database_is_dirty = True
         return entry
 
     def get_entry(self, text_id: int) -> URLDatabaseEntry | None:
@@ -177,10 +926,26 @@ class URLDatabase:
         entry = self.database_entries.get(text_id)
         if entry is None:
             raise ValueError(f"Entry with text_id {text_id} does not exist")
-        data = asdict(entry)
-        data.update(values)
-        self.database_entries[text_id] = URLDatabaseEntry(**data)
-        self.database_is_dirty = True
+        assert "text_id" not in values, "text_id cannot be changed"
+        old_url = entry.url
+        new_url = values.get("url", old_url)
+        if new_url != old_url:
+            assert new_url not in self.database_entries_by_url, (
+                f"Entry with url {new_url} already exists"
+            )
+
+        if self.journal is not None:
+            self.journal.append(text_id, values)
+
+        # Entries are updated in place rather than copied
+        for key, value in values.items():
+            object.__setattr__(entry, key, value)
+        entry._coerce_fields()
+
+        if new_url != old_url:
+            del self.database_entries_by_url[old_url]
+            self.database_entries_by_url[new_url] = entry
+        self._write_entry(entry)
 
     def __contains__(self, url: str | int) -> bool:
         if isinstance(url, int):
@@ -196,11 +961,7 @@ def create_new_database(database_path: str | Path):
     database_path = Path(database_path)
     assert not database_path.exists(), f"Database file {database_path} already exists"
 
-    with open(database_path, "w") as f:
-        writer = csv.DictWriter(
-            f, fieldnames=URLDatabaseEntry.__dataclass_fields__.keys()
-        )
-        writer.writeheader()
+    database_backend(database_path).create()
 
 
 def _centeton_to_url(ceneton_slug: str) -> str:
@@ -217,51 +978,122 @@ def _centeton_to_url(ceneton_slug: str) -> str:
     return url
 
 
+@dataclass
+class PopulateDiff:
+    """The changes importing a source would make to the database."""
+
+    added: list[dict[str, Any]] = field(default_factory=list)
+    updated: list[tuple[int, dict[str, Any]]] = field(default_factory=list)
+    skipped: int = 0
+    conflicting: list[str] = field(default_factory=list)
+
+    def apply(self, database: URLDatabase):
+        if not self.added and not self.updated:
+            return
+
+        with database.batch():
+            for values in self.added:
+                database.add_entry(**values)
+            for text_id, values in self.updated:
+                database.update_entry(text_id, **values)
+        database.save_database()
+
+    def print_summary(self, database: URLDatabase, verbose: bool = False):
+        if verbose:
+            for values in self.added:
+                print(f"+ {values['url']}")
+            for text_id, values in self.updated:
+                print(f"~ {database.get_entry(text_id).url}")
+        for message in self.conflicting:
+            print(f"! {message}")
+
+        print(
+            f"Added {len(self.added)}, updated {len(self.updated)}, skipped "
+            f"{self.skipped}, conflicting {len(self.conflicting)}"
+        )
+
+
+def _find_table(conn: sqlite3.Connection) -> str:
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    database_table = cursor.fetchone()[0]
+    assert database_table is not None, "No tables found in database"
+    return database_table
+
+
 def populate_from_sqlite(
-    database: URLDatabase, sqlite_path: str | Path, database_table: str | None = None
-):
+    database: URLDatabase,
+    sqlite_path: str | Path,
+    database_table: str | None = None,
+    dry_run: bool = False,
+) -> PopulateDiff:
+    """Add an entry for every census row whose URL is not in the database yet.
+
+    Rows whose URL is already stored under a different source slug, for example by
+    a mapping, are reported as conflicting. With dry_run the database is left
+    untouched and the changes are listed.
+    """
     sqlite_path = Path(sqlite_path)
     assert sqlite_path.exists(), f"SQLite file {sqlite_path} does not exist"
 
+    diff = PopulateDiff()
+    # Source slugs by url, including the planned additions
+    known = {
+        url: entry.source_slug
+        for url, entry in database.database_entries_by_url.items()
+    }
     with sqlite3.connect(sqlite_path) as conn:
         if database_table is None:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            database_table = cursor.fetchone()[0]
-            assert database_table is not None, "No tables found in database"
+            database_table = _find_table(conn)
 
-        cursor = conn.cursor()
-        cursor.execute(
+        # Rows are streamed from the cursor rather than fetched all at once
+        cursor = conn.execute(
             f"SELECT http FROM {database_table} where http is not null order by http"
         )
-        # We want to fetch as dictionaries
-        for row in cursor.fetchall():
-            slug = row[0]
+        for (slug,) in cursor:
             url = _centeton_to_url(slug)
+            source_slug = "ceneton:" + slug
+            if url not in known:
+                known[url] = source_slug
+                diff.added.append({"url": url, "source_slug": source_slug})
+            elif known[url] != source_slug:
+                diff.conflicting.append(
+                    f"{url} already exists with a different source slug: "
+                    f"{known[url]} != {source_slug}"
+                )
+            else:
+                diff.skipped += 1
 
-            if url in database:
-                print(f"Skipping {url} because it already exists")
-                continue
+    diff.print_summary(database, verbose=dry_run)
+    if not dry_run:
+        diff.apply(database)
+    return diff
 
-            entry = database.add_entry(url=url, source_slug="ceneton:" + slug)
-            print("Added", entry)
-        database.save_database()
 
+def populate_from_mappings(
+    database: URLDatabase, csv_path: str | Path, dry_run: bool = False
+) -> PopulateDiff:
+    """Add or update an entry for every corrected slug in a mappings file.
 
-def populate_from_mappings(database: URLDatabase, csv_path: str | Path):
+    Entries that already exist are only updated if they came from the same mapping
+    slug, otherwise they are reported as conflicting. With dry_run the database is
+    left untouched and the changes are listed.
+    """
     csv_path = Path(csv_path)
     assert csv_path.exists(), f"CSV file {csv_path} does not exist"
 
     mapping_name = csv_path.stem
     mapping_sha256 = hashlib.sha256(csv_path.read_bytes()).hexdigest()[:8]
 
+    diff = PopulateDiff()
+    # Additions by url, so a repeated row updates the planned entry
+    planned: dict[str, dict[str, Any]] = {}
     with open(csv_path, "r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
+        for row in csv.DictReader(f):
             ceneton_slug = row["ceneton_slug"]
             corrected_slug = row["corrected_slug"]
             if not corrected_slug.strip():
-                print(f"Skipping {ceneton_slug} because it has no corrected slug")
+                diff.skipped += 1
                 continue
 
             url = _centeton_to_url(corrected_slug)
@@ -272,15 +1104,24 @@ def populate_from_mappings(database: URLDatabase, csv_path: str | Path):
                 "comments": f"Mapped from {mapping_name}@{mapping_sha256}",
             }
 
-            if url in database:
-                entry = database.get_entry_by_url(url)
-                if entry.source_slug == data["source_slug"]:
-                    database.update_entry(entry.text_id, **data)
-                else:
-                    print(
-                        f"Skipping {url} because it already exists with a different "
-                        f"source slug: {entry.source_slug} != {data['source_slug']}"
-                    )
+            entry = database.get_entry_by_url(url)
+            existing = planned.get(url) or (entry and _entry_row(entry))
+            if not existing:
+                planned[url] = data
+                diff.added.append(data)
+            elif existing["source_slug"] != data["source_slug"]:
+                diff.conflicting.append(
+                    f"{url} already exists with a different source slug: "
+                    f"{existing['source_slug']} != {data['source_slug']}"
+                )
+            elif url in planned:
+                planned[url].update(data)
+            elif any(existing[k] != v for k, v in data.items()):
+                diff.updated.append((entry.text_id, data))
             else:
-                database.add_entry(**data)
-        database.save_database()
+                diff.skipped += 1
+
+    diff.print_summary(database, verbose=dry_run)
+    if not dry_run:
+        diff.apply(database)
+    return diff
@@ -0,0 +1,217 @@
+import hashlib
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from tqdm import tqdm
+
+from ceneton_texts_utils import metrics
+from ceneton_texts_utils.compression import open_stored, stored_codec
+from ceneton_texts_utils.url_database import (
+    URLDatabase,
+    URLDatabaseEntry,
+    URLDatabaseEntryMetadata,
+)
+
+# Problems found in the archive
+CORRUPT = "corrupt"
+MISSING = "missing"
+ORPHANED = "orphaned"
+TRUNCATED = "truncated"
+KINDS = (CORRUPT, MISSING, ORPHANED, TRUNCATED)
+
+_HUNDREDS_FOLDER = re.compile(r"^\d{4}-\d{4}$")
+_ENTRY_FOLDER = re.compile(r"^\d{4,}$")
+_DURATION = re.compile(r"^(\d+)([mhd])$")
+
+# Compressed files are hashed in chunks of this size as they are decompressed
+_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Problem:
+    text_id: int
+    kind: str
+    detail: str
+
+
+def parse_since(value: str, now: datetime | None = None) -> datetime:
+    """Parse a time given as an ISO date or as an age such as 30m, 24h or 7d."""
+    match = _DURATION.match(value)
+    if match:
+        amount, unit = int(match[1]), match[2]
+        unit = {"m": "minutes", "h": "hours", "d": "days"}[unit]
+        return (now or datetime.now(tz=timezone.utc)) - timedelta(**{unit: amount})
+
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is None:
+        # Local time, as typed on the command line
+        since = since.astimezone()
+    return since
+
+
+def _hash_file(path: Path) -> tuple[str, int]:
+    """Return the sha256 and length of the uncompressed content of a stored file."""
+    if stored_codec(path) is None:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return hashlib.sha256().hexdigest(), 0
+            # Hashing the mapped file avoids copying it through a read buffer
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return hashlib.sha256(data).hexdigest(), size
+
+    sha256 = hashlib.sha256()
+    length = 0
+    with open_stored(path) as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            sha256.update(chunk)
+            length += len(chunk)
+    return sha256.hexdigest(), length
+
+
+def _check_content(
+    text_id: int, path: str, sha256: str | None, content_length: int | None
+) -> Problem | None:
+    """Check one content file against its metadata. Runs in a worker process.
+
+    A recorded sha256 decides on its own. The content_length of older metadata is
+    the Content-Length header, which is 0 when the header was missing and the
+    compressed size when the page was sent gzip-encoded, so it is only checked
+    when there is no sha256.
+    """
+    path = Path(path)
+    if sha256 is not None:
+        content_length = None
+    try:
+        # A plain file that is too short can be reported without reading it
+        if stored_codec(path) is None and content_length is not None:
+            size = path.stat().st_size
+            if size < content_length:
+                return Problem(
+                    text_id, TRUNCATED, f"{size} of {content_length} bytes on disk"
+                )
+
+        actual_sha256, length = _hash_file(path)
+    except FileNotFoundError:
+        return Problem(text_id, MISSING, f"{path.name} was removed during the check")
+    except (EOFError, OSError) as e:
+        # Compressed files that end early fail to decompress
+        return Problem(text_id, TRUNCATED, f"{path.name} is unreadable: {e}")
+
+    if sha256 is not None and actual_sha256 != sha256:
+        return Problem(
+            text_id, CORRUPT, f"sha256 is {actual_sha256[:12]}, not {sha256[:12]}"
+        )
+    if content_length is not None and length < content_length:
+        return Problem(text_id, TRUNCATED, f"{length} of {content_length} bytes")
+    if content_length is not None and length != content_length:
+        return Problem(
+            text_id, CORRUPT, f"{length} bytes, metadata says {content_length}"
+        )
+    return None
+
+
+def _find_orphans(database: URLDatabase) -> list[Problem]:
+    """Archive folders that do not belong to any entry in the database."""
+    orphans = []
+    for hundreds in database.database_path.parent.iterdir():
+        if not (hundreds.is_dir() and _HUNDREDS_FOLDER.match(hundreds.name)):
+            continue
+        for folder in hundreds.iterdir():
+            if not (folder.is_dir() and _ENTRY_FOLDER.match(folder.name)):
+                continue
+            text_id = int(folder.name)
+            if text_id not in database:
+                orphans.append(
+                    Problem(text_id, ORPHANED, f"{folder} has no database entry")
+                )
+            elif database.get_entry(text_id).archive_folder != folder:
+                orphans.append(
+                    Problem(text_id, ORPHANED, f"{folder} is in the wrong folder")
+                )
+    return orphans
+
+
+def _should_have_content(entry: URLDatabaseEntry) -> bool:
+    return not entry.skip and entry.last_status == 200
+
+
+def _content_changed(
+    entry: URLDatabaseEntry, metadata: URLDatabaseEntryMetadata | None
+) -> datetime | None:
+    """When the content of an entry was last written, if known."""
+    if metadata is not None and metadata.last_changed is not None:
+        return metadata.last_changed
+    try:
+        mtime = entry.content_path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    return datetime.fromtimestamp(mtime, tz=timezone.utc)
+
+
+def verify_archive(
+    database: URLDatabase, jobs: int | None = None, since: datetime | None = None
+) -> list[Problem]:
+    """Check the content of every entry against the sha256 in its metadata.
+
+    Entries last downloaded successfully, and entries with a recorded sha256, must
+    have content or they are reported as missing. Content is hashed in a pool of
+    jobs processes, one per CPU by default, so hashing keeps up with the disk.
+    Content without a sha256 is checked against its recorded length instead, and
+    plain files shorter than that are reported as truncated without being read.
+    With since, only entries whose content changed at or after that time are
+    verified, going by last_changed in the metadata or else the content file's
+    mtime. Checks that found the content unchanged do not count. Archive folders
+    without a database entry are always reported as orphaned.
+    """
+    problems = _find_orphans(database)
+
+    checks = []
+    for entry in database:
+        metadata = entry.metadata
+        if since is not None:
+            changed = _content_changed(entry, metadata)
+            if changed is None or changed < since:
+                continue
+
+        content_path = entry.content_path
+        if not content_path.exists():
+            if _should_have_content(entry) or (metadata and metadata.sha256):
+                problems.append(
+                    Problem(entry.text_id, MISSING, f"no {content_path.name}")
+                )
+            continue
+
+        if metadata is None:
+            problem = Problem(entry.text_id, ORPHANED, "content without metadata")
+            problems.append(problem)
+            continue
+
+        checks.append(
+            (
+                entry.text_id,
+                str(content_path),
+                metadata.sha256,
+                metadata.content_length,
+            )
+        )
+
+    if checks:
+        jobs = jobs or os.cpu_count() or 1
+        # Small files are sent to the workers in batches, to keep the overhead of
+        # the pool low
+        chunksize = max(1, min(64, len(checks) // (jobs * 8)))
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=metrics.init_worker
+        ) as executor:
+            results = executor.map(_check_content, *zip(*checks), chunksize=chunksize)
+            for problem in tqdm(results, total=len(checks)):
+                if problem is not None:
+                    problems.append(problem)
+
+    return sorted(problems, key=lambda p: (p.text_id, p.kind))
@@ -1,14 +1,41 @@
 import hashlib
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import cached_property
 from pathlib import Path
 
+from tqdm import tqdm
+
+from ceneton_texts_utils import html_text, metrics
+from ceneton_texts_utils.compression import get_codec, stored_codec
 from ceneton_texts_utils.url_database import URLDatabaseEntry
 
 
 class W3M:
+    name = "w3m"
+    # The work happens in the w3m process, so threads are enough to run it in
+    # parallel
+    uses_processes = False
+
     def __init__(self, w3m_path: str | None = None):
         self.w3m_path = w3m_path or "w3m"
 
+    @cached_property
+    def version(self) -> str:
+        s = subprocess.run(f"{self.w3m_path} -version", shell=True, capture_output=True)
+        s.check_returncode()
+
+        # "w3m version w3m/0.5.3+git20230121, options ..."
+        first_line = s.stdout.decode("utf-8").splitlines()[0]
+        return first_line.split()[2].rstrip(",")
+
+    @property
+    def converter_id(self) -> str:
+        """Identifies the converter and version recorded with every content.txt."""
+        return f"{self.name} {self.version}"
+
     def convert(self, html_path: Path, text_path: Path) -> str:
         html_path_str = html_path.absolute().resolve().as_posix()
 
@@ -20,21 +47,162 @@ class W3M:
         text = s.stdout.decode("utf-8")
         return text
 
-    def convert_entry(self, entry: URLDatabaseEntry) -> str:
-        text_path = entry.archive_folder / "content.txt"
-        if text_path.exists():
-            text = text_path.read_text()
-            hashlib.sha256(text.encode("utf-8")).hexdigest()
+    def entry_text(self, entry: URLDatabaseEntry, text_path: Path) -> str:
+        if stored_codec(entry.content_path) is None:
+            return self.convert(entry.content_path, text_path)
 
-            content = entry.content
-            hashlib.sha256(content).hexdigest()
+        # w3m needs an uncompressed file to read
+        with tempfile.NamedTemporaryFile(suffix=".html") as f:
+            f.write(entry.content)
+            f.flush()
+            return self.convert(Path(f.name), text_path)
 
-            # SKIP IF NOT UPDATED
+    def needs_conversion(self, entry: URLDatabaseEntry) -> bool:
+        """Check if an entry's content.txt is missing or out of date.
 
-        text = self.convert(entry.content_path, text_path)
+        An entry is up to date if content.txt was converted from HTML with the same
+        sha256 by the same converter. Both are compared against the metadata, so
+        neither file has to be read.
+        """
+        metadata = entry.metadata
+        return not (
+            metadata is not None
+            and metadata.sha256 is not None
+            and metadata.text_source_sha256 == metadata.sha256
+            and metadata.text_converter == self.converter_id
+            and entry.text_path.exists()
+        )
 
-        text_path.write_text(text)
+    def write_text(self, entry: URLDatabaseEntry, compress: str | None = None) -> str:
+        """Convert an entry and write content.txt, without touching its metadata.
 
-        # entry.save_content(text.encode("utf-8"))
+        Args:
+            entry: The entry to convert
+            compress: Name of the codec to store content.txt with, if any
 
+        """
+        text = self.entry_text(entry, entry.text_path)
+        entry.save_text(text, get_codec(compress))
         return text
+
+    def record_conversion(self, entry: URLDatabaseEntry):
+        """Record the source HTML and converter of content.txt in the metadata."""
+        metadata = entry.metadata
+        if metadata is None:
+            return
+
+        if metadata.sha256 is None:
+            metadata.sha256 = hashlib.sha256(entry.content).hexdigest()
+        metadata.text_source_sha256 = metadata.sha256
+        metadata.text_converter = self.converter_id
+        entry.save_metadata(metadata)
+
+    def convert_entry(
+        self, entry: URLDatabaseEntry, force: bool = False, compress: str | None = None
+    ) -> str | None:
+        """Convert an entry to content.txt, unless it is already up to date.
+
+        Returns None if the entry was skipped.
+        """
+        if not force and not self.needs_conversion(entry):
+            return None
+
+        text = self.write_text(entry, compress)
+        self.record_conversion(entry)
+        return text
+
+
+class BuiltinConverter(W3M):
+    """Converts HTML in-process with html.parser instead of running w3m.
+
+    The output approximates `w3m -dump` closely for the markup used in the Ceneton
+    transcriptions, without the cost of starting a shell and w3m for every page.
+    """
+
+    name = "builtin"
+    uses_processes = True
+
+    def __init__(self, width: int = 80):
+        self.width = width
+
+    @property
+    def version(self) -> str:
+        return f"{html_text.VERSION} cols={self.width}"
+
+    def convert(self, html_path: Path, text_path: Path) -> str:
+        return html_text.html_to_text(html_path.read_bytes(), width=self.width)
+
+    def entry_text(self, entry: URLDatabaseEntry, text_path: Path) -> str:
+        return html_text.html_to_text(entry.content, width=self.width)
+
+
+CONVERTERS = {
+    "w3m": W3M,
+    "builtin": BuiltinConverter,
+}
+
+
+def _content_size(entry: URLDatabaseEntry) -> int:
+    try:
+        return entry.content_path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _write_text_timed(
+    converter: W3M, entry: URLDatabaseEntry, compress: str | None
+) -> float:
+    start = time.perf_counter()
+    converter.write_text(entry, compress)
+    return time.perf_counter() - start
+
+
+def convert_entries(
+    converter: W3M,
+    entries: list[URLDatabaseEntry],
+    jobs: int = 1,
+    force: bool = False,
+    compress: str | None = None,
+) -> tuple[int, dict[int, Exception]]:
+    """Convert entries in parallel, returning the number converted and any errors.
+
+    The largest files are started first so a few big pages do not hold up the end
+    of the batch. A failing entry does not stop the others: its error is returned
+    by text_id instead. Metadata is only written from the calling process.
+    """
+    assert jobs > 0, "jobs must be positive"
+
+    pending = [e for e in entries if force or converter.needs_conversion(e)]
+    pending.sort(key=_content_size, reverse=True)
+
+    converted = 0
+    errors: dict[int, Exception] = {}
+    if converter.uses_processes:
+        executor = ProcessPoolExecutor(
+            max_workers=jobs, initializer=metrics.init_worker
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+
+    with executor:
+        futures = {
+            executor.submit(_write_text_timed, converter, entry, compress): entry
+            for entry in pending
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            entry = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as e:
+                errors[entry.text_id] = e
+                metrics.count("entries_total", result="failed")
+                continue
+
+            metrics.observe("convert_seconds", seconds, engine=converter.name)
+            converter.record_conversion(entry)
+            converted += 1
+
+    metrics.count("entries_total", converted, result="converted")
+    metrics.count("entries_total", len(entries) - len(pending), result="up_to_date")
+
+    return converted, errors
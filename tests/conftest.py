@@ -0,0 +1,7 @@
+def pytest_addoption(parser):
+    parser.addoption(
+        "--record-w3m",
+        action="store_true",
+        default=False,
+        help="Record the w3m -dump output of the sample pages in tests/fixtures/w3m",
+    )
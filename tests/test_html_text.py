@@ -0,0 +1,67 @@
+"""Parity of the builtin converter with w3m -dump on sample Ceneton pages.
+
+Where w3m is installed the builtin converter is compared with its output directly.
+The output can also be recorded next to a page in fixtures/w3m as a .txt file, so
+the comparison runs without w3m as well:
+
+    pytest tests/test_html_text.py --record-w3m
+"""
+
+import shutil
+from pathlib import Path
+
+import pytest
+
+from ceneton_texts_utils.html_text import html_to_text
+from ceneton_texts_utils.w3m import W3M
+
+FIXTURES = Path(__file__).parent / "fixtures" / "w3m"
+PAGES = sorted(FIXTURES.glob("*.html"))
+RECORDED = [page for page in PAGES if page.with_suffix(".txt").exists()]
+
+requires_w3m = pytest.mark.skipif(
+    shutil.which("w3m") is None, reason="w3m is not installed"
+)
+
+
+@pytest.fixture
+def record_w3m(request) -> bool:
+    return request.config.getoption("--record-w3m")
+
+
+@requires_w3m
+@pytest.mark.parametrize("page", PAGES, ids=lambda page: page.stem)
+def test_builtin_matches_w3m(page: Path, record_w3m: bool):
+    recorded_path = page.with_suffix(".txt")
+    dumped = W3M().convert(page, recorded_path)
+    if record_w3m:
+        recorded_path.write_text(dumped, encoding="utf-8")
+
+    assert html_to_text(page.read_bytes()) == dumped
+
+
+@pytest.mark.skipif(not RECORDED, reason="no w3m output is recorded")
+@pytest.mark.parametrize("page", RECORDED, ids=lambda page: page.stem)
+def test_builtin_matches_recording(page: Path):
+    recorded = page.with_suffix(".txt").read_text(encoding="utf-8")
+    assert html_to_text(page.read_bytes()) == recorded
+
+
+def test_unclosed_paragraph_ends_with_parent():
+    text = html_to_text("<center><p>TITLE</center><p>Body text")
+    assert text == f"{'TITLE'.center(80).rstrip()}\n\nBody text\n"
+
+
+def test_unclosed_paragraph_ends_at_next_block():
+    text = html_to_text("<p align=center>Title<p>Body")
+    assert text == f"{'Title'.center(80).rstrip()}\n\nBody\n"
+
+
+def test_unclosed_list_items():
+    text = html_to_text("<dl><dt>Term<dd>One<dt>Other<dd>Two</dl>After")
+    assert text == "Term\n    One\nOther\n    Two\n\nAfter\n"
+
+
+def test_unclosed_pre_is_kept():
+    text = html_to_text("<p>intro<pre>line one\n  line two")
+    assert text == "intro\n\nline one\n  line two\n"